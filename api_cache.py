@@ -0,0 +1,176 @@
+"""On-disk cache for API responses, so re-running an audit does not download everything again"""
+
+import json
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = '.api_cache.sqlite3'
+CACHE_MAX_BYTES = 1024 * 1024 * 1024 #1GB disk budget, least recently used entries are evicted above it
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# seconds a response stays fresh per route, routes not listed here are never cached
+ROUTE_TTLS = {
+    'album': 30 * DAY, #name, company and publish time practically never change
+    'lyric': 30 * DAY,
+    'song/detail': 7 * DAY,
+    'artists': 7 * DAY,
+    'artist/songs': DAY,
+    'search': DAY,
+    'comment/event': HOUR, #comment and follower counts go stale quickly
+    'artist/follow/count': HOUR,
+}
+
+
+def make_cache_key(route, params=None) -> str:
+    """route plus the sorted query parameters, so {'id': 1} and {'id': '1'} hit the same entry"""
+    normalized = sorted((str(key), str(value).strip()) for key, value in (params or {}).items())
+
+    return route.strip('/') + '?' + json.dumps(normalized, ensure_ascii=False, separators=(',', ':'))
+
+
+class ResponseCache():
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES, route_ttls=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.route_ttls = dict(ROUTE_TTLS if route_ttls is None else route_ttls)
+        self.lock = threading.Lock()
+
+        # one connection shared by all threads, sqlite handles locking between processes
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                cache_key TEXT PRIMARY KEY,
+                route TEXT,
+                body TEXT,
+                size INTEGER,
+                expires_at REAL,
+                accessed_at REAL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_idx ON responses (accessed_at)")
+
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+
+    def ttl_for(self, route) -> int:
+        return self.route_ttls.get(route.strip('/'), 0)
+
+
+    def get(self, route, params=None):
+        """Returns the cached json or None if there is no fresh entry"""
+        if not self.ttl_for(route):
+            return None
+
+        key = make_cache_key(route, params)
+        now = time.time()
+
+        with self.lock:
+            row = self.conn.execute("SELECT body, expires_at FROM responses WHERE cache_key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            body, expires_at = row
+            if expires_at < now:
+                return None
+
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE cache_key = ?", (now, key))
+
+        return json.loads(body)
+
+
+    def set(self, route, params, data) -> None:
+        ttl = self.ttl_for(route)
+        if not ttl:
+            return
+
+        key = make_cache_key(route, params)
+        body = json.dumps(data, ensure_ascii=False)
+        size = len(body.encode('utf-8'))
+        now = time.time()
+
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE cache_key = ?", (key,)).fetchone()
+            self.conn.execute("""
+                INSERT OR REPLACE INTO responses (cache_key, route, body, size, expires_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?)""", (key, route.strip('/'), body, size, now + ttl, now))
+
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+
+    def evict(self) -> None:
+        """Drop expired entries, then the least recently used ones until we are 10% under budget"""
+        self.conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        target = self.max_bytes * 0.9
+        while self.total_bytes > target:
+            rows = self.conn.execute("SELECT cache_key, size FROM responses ORDER BY accessed_at LIMIT 500").fetchall()
+            if not rows:
+                break
+
+            self.conn.executemany("DELETE FROM responses WHERE cache_key = ?", [(row[0],) for row in rows])
+            self.total_bytes -= sum(row[1] for row in rows)
+
+
+    def invalidate(self, route, params=None) -> None:
+        key = make_cache_key(route, params)
+        with self.lock:
+            self.conn.execute("DELETE FROM responses WHERE cache_key = ?", (key,))
+            self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+
+    def clear(self) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.total_bytes = 0
+
+
+class AlbumCache():
+    """Album name, company and publish time never change once released, so they are kept without expiry"""
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS albums (
+                album_id INTEGER PRIMARY KEY,
+                album_name TEXT,
+                company TEXT,
+                publish_time INTEGER
+            )
+        """)
+
+
+    def get_many(self, album_ids) -> dict:
+        album_ids = [int(album_id) for album_id in album_ids]
+        albums = {}
+
+        with self.lock:
+            # stay below sqlite's limit of host parameters per statement
+            for i in range(0, len(album_ids), 500):
+                chunk = album_ids[i:i + 500]
+                rows = self.conn.execute(f"""
+                    SELECT album_id, album_name, company, publish_time FROM albums
+                    WHERE album_id IN ({','.join('?' * len(chunk))})""", chunk).fetchall()
+
+                for album_id, album_name, company, publish_time in rows:
+                    albums[album_id] = {"album_name": album_name, "company": company, "publish_time": publish_time}
+
+        return albums
+
+
+    def set_many(self, albums: dict) -> None:
+        rows = [(int(album_id), album["album_name"], album["company"], album["publish_time"]) for album_id, album in albums.items()]
+
+        with self.lock:
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO albums (album_id, album_name, company, publish_time)
+                VALUES (?, ?, ?, ?)""", rows)
@@ -0,0 +1,352 @@
+"""Shared HTTP client for all calls to the NeteaseCloudMusicApi instances"""
+
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import urlsplit, parse_qsl
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from api_cache import ResponseCache, AlbumCache, make_cache_key, CACHE_PATH, CACHE_MAX_BYTES
+from rate_limiter import RateLimiter, is_throttle_response
+from api_endpoints import EndpointPool, HEALTH_CHECK_ROUTE
+from api_latency import LatencyTracker, CircuitBreaker, CircuitOpenError, hedged_call, is_route_failure, HEDGED_ROUTES, HEDGE_PERCENTILE
+
+API_HOST = 'http://18.119.235.232:3000'
+API_HOSTS = [API_HOST] #replicas requests are balanced across, calls for API_HOST are routed to any of them
+
+MAX_IN_FLIGHT = 100 #requests running at the same time across the whole process
+POOL_SIZE = MAX_IN_FLIGHT #keep-alive connections kept open to API_HOST
+CONNECT_TIMEOUT = 5 #seconds
+READ_TIMEOUT = 30 #seconds
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5 #sleeps 0.5s, 1s, 2s between retries
+RATE_LIMIT_ENABLED = True #see rate_limiter.py, the budget is shared by all processes on this host
+CACHE_ENABLED = True #see api_cache.ROUTE_TTLS for which routes are cached and for how long
+HEDGING_ENABLED = True #see api_latency.HEDGED_ROUTES
+
+_session = None
+_session_lock = threading.Lock()
+_executor = None
+_cache = None
+_album_cache = None
+_rate_limiter = None
+_endpoint_pool = None
+
+latency_tracker = LatencyTracker()
+_breakers = {}
+
+# requests currently on the wire, cache key -> Future shared by every caller asking for the same resource
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def configure_client(pool_size=None, connect_timeout=None, read_timeout=None, max_retries=None, backoff_factor=None,
+                     max_in_flight=None, cache_enabled=None, cache_path=None, cache_max_bytes=None, rate_limit_enabled=None,
+                     api_hosts=None, hedging_enabled=None):
+    """Change the client settings. The pooled session, worker threads, cache and replica pool are rebuilt on the next request"""
+    global POOL_SIZE, CONNECT_TIMEOUT, READ_TIMEOUT, MAX_RETRIES, BACKOFF_FACTOR, MAX_IN_FLIGHT, CACHE_ENABLED
+    global CACHE_PATH, CACHE_MAX_BYTES, RATE_LIMIT_ENABLED, API_HOSTS, HEDGING_ENABLED
+    global _session, _executor, _cache, _album_cache, _endpoint_pool
+
+    with _session_lock:
+        HEDGING_ENABLED = hedging_enabled if hedging_enabled is not None else HEDGING_ENABLED
+        API_HOSTS = list(api_hosts) if api_hosts is not None else API_HOSTS
+        RATE_LIMIT_ENABLED = rate_limit_enabled if rate_limit_enabled is not None else RATE_LIMIT_ENABLED
+        CACHE_ENABLED = cache_enabled if cache_enabled is not None else CACHE_ENABLED
+        CACHE_PATH = cache_path if cache_path is not None else CACHE_PATH
+        CACHE_MAX_BYTES = cache_max_bytes if cache_max_bytes is not None else CACHE_MAX_BYTES
+        MAX_IN_FLIGHT = max_in_flight if max_in_flight is not None else MAX_IN_FLIGHT
+        POOL_SIZE = pool_size if pool_size is not None else max(POOL_SIZE, MAX_IN_FLIGHT)
+        CONNECT_TIMEOUT = connect_timeout if connect_timeout is not None else CONNECT_TIMEOUT
+        READ_TIMEOUT = read_timeout if read_timeout is not None else READ_TIMEOUT
+        MAX_RETRIES = max_retries if max_retries is not None else MAX_RETRIES
+        BACKOFF_FACTOR = backoff_factor if backoff_factor is not None else BACKOFF_FACTOR
+
+        if _session is not None:
+            _session.close()
+            _session = None
+
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+        if _cache is not None:
+            _cache.conn.close()
+            _cache = None
+
+        if _album_cache is not None:
+            _album_cache.conn.close()
+            _album_cache = None
+
+        if _endpoint_pool is not None:
+            _endpoint_pool.stop()
+            _endpoint_pool = None
+
+
+def get_session() -> requests.Session:
+    """One keep-alive session shared by every thread of the process"""
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # only connection problems are retried here, throttled responses are retried in fetch_json
+                # so that every attempt goes through the rate limiter
+                retry = Retry(
+                    total=MAX_RETRIES,
+                    backoff_factor=BACKOFF_FACTOR,
+                    status=0,
+                    allowed_methods=frozenset(["GET"]),
+                )
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+
+    return _session
+
+
+def get_cache() -> ResponseCache:
+    global _cache
+
+    if _cache is None:
+        with _session_lock:
+            if _cache is None:
+                _cache = ResponseCache(CACHE_PATH, CACHE_MAX_BYTES)
+
+    return _cache
+
+
+def get_album_cache() -> AlbumCache:
+    global _album_cache
+
+    if _album_cache is None:
+        with _session_lock:
+            if _album_cache is None:
+                _album_cache = AlbumCache(CACHE_PATH)
+
+    return _album_cache
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+
+    if _rate_limiter is None:
+        with _session_lock:
+            if _rate_limiter is None:
+                _rate_limiter = RateLimiter()
+
+    return _rate_limiter
+
+
+def get_breaker(route) -> CircuitBreaker:
+    with _session_lock:
+        if route not in _breakers:
+            _breakers[route] = CircuitBreaker()
+
+        return _breakers[route]
+
+
+def check_endpoint(host) -> bool:
+    response = get_session().get(build_url(HEALTH_CHECK_ROUTE, host), timeout=(CONNECT_TIMEOUT, CONNECT_TIMEOUT))
+
+    return response.status_code < 500
+
+
+def get_endpoint_pool() -> EndpointPool:
+    global _endpoint_pool
+
+    if _endpoint_pool is None:
+        with _session_lock:
+            if _endpoint_pool is None:
+                _endpoint_pool = EndpointPool(API_HOSTS, check=check_endpoint)
+
+    return _endpoint_pool
+
+
+def build_url(route, host=None):
+    return '/'.join([(host or API_HOST).rstrip('/'), route.lstrip('/')])
+
+
+def split_api_url(url):
+    """'http://host:3000/artist/songs?id=1' -> ('http://host:3000', 'artist/songs', {'id': '1'})"""
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    params = dict(parse_qsl(parts.query, keep_blank_values=True))
+
+    return host, parts.path.lstrip('/'), params
+
+
+def decode_json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+def send_get(url, params, connect_timeout, read_timeout, hedge_timeout=None) -> requests.Response:
+    return get_session().get(url, params=params, timeout=(connect_timeout, hedge_timeout or read_timeout))
+
+
+def fetch_json(route, params=None, host=None, timeout=None, hedge_after=None) -> dict:
+    """The actual HTTP request, without cache or coalescing.
+    Calls for API_HOST (or no host) go to the replica with the fewest outstanding requests.
+    429/5xx and netease throttle codes slow down the shared rate limiter and are retried with backoff.
+    With hedge_after, a send slower than that is sent again, see api_latency.hedged_call"""
+    pool = get_endpoint_pool()
+    use_pool = host is None or host.rstrip('/') == API_HOST or host in pool
+    limiter = get_rate_limiter() if RATE_LIMIT_ENABLED else None
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout or CONNECT_TIMEOUT, timeout or READ_TIMEOUT)
+
+    for attempt in range(MAX_RETRIES + 1):
+        target = pool.acquire() if use_pool else host
+        ok = False
+        try:
+            if limiter is not None:
+                limiter.acquire(target)
+
+            # only the send is hedged, the token is already taken and a throttled api gets no extra requests
+            send = functools.partial(send_get, build_url(route, target), params, connect_timeout, read_timeout)
+            can_hedge = (lambda: not limiter.backing_off(target)) if limiter is not None else None
+            started = time.monotonic()
+            response = hedged_call(send, hedge_after, can_hedge)
+            ok = response.status_code < 500
+            latency_tracker.record(route, time.monotonic() - started)
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # another replica may still be up
+            if use_pool and attempt < MAX_RETRIES and len(pool.endpoints) > 1:
+                continue
+            raise
+
+        finally:
+            if use_pool:
+                pool.release(target, ok)
+
+        data = decode_json(response)
+
+        if not is_throttle_response(response.status_code, data):
+            response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
+            return data if data is not None else response.json()
+
+        if limiter is not None:
+            limiter.throttle(target)
+
+        if attempt < MAX_RETRIES:
+            time.sleep(BACKOFF_FACTOR * (2 ** attempt))
+
+    # out of retries
+    response.raise_for_status()
+    raise requests.exceptions.HTTPError(f"API throttled {route} with code {(data or {}).get('code')}", response=response)
+
+
+def api_get(route, params=None, host=None, timeout=None, use_cache=True) -> dict:
+    """GET an API route through the pooled session and return the decoded json.
+    Fresh responses are served from the on-disk cache without a request, and callers asking for a
+    resource that is already being fetched wait for that request instead of sending their own.
+    Coalesced callers share one dict, so treat the result as read-only.
+    Slow calls on HEDGED_ROUTES are sent again, and routes that keep failing raise CircuitOpenError"""
+    cache = get_cache() if use_cache and CACHE_ENABLED else None
+    if cache is not None:
+        cached = cache.get(route, params)
+        if cached is not None:
+            return cached
+
+    key = make_cache_key(route, params)
+    with _in_flight_lock:
+        call = _in_flight.get(key)
+        is_leader = call is None
+        if is_leader:
+            call = _in_flight[key] = Future()
+
+    if not is_leader:
+        return call.result()
+
+    breaker = get_breaker(route)
+    try:
+        breaker.before_call(route)
+
+        if HEDGING_ENABLED and route in HEDGED_ROUTES:
+            data = fetch_json(route, params, host, timeout, latency_tracker.percentile(route, HEDGE_PERCENTILE))
+        else:
+            data = fetch_json(route, params, host, timeout)
+
+        breaker.record_success()
+
+        # the api reports some failures with a 200 status and an error code in the body, never cache those
+        if cache is not None and data.get('code', 200) == 200:
+            cache.set(route, params, data)
+
+        call.set_result(data)
+        return data
+
+    except BaseException as error:
+        if is_route_failure(error):
+            breaker.record_failure(route)
+        elif not isinstance(error, CircuitOpenError):
+            # the route answered (e.g. a 404), it is not unhealthy
+            breaker.record_success()
+
+        call.set_exception(error)
+        raise
+
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+
+def api_get_url(url, extra_params=None, use_cache=True) -> dict:
+    """Same as api_get for callers that already built the full url"""
+    host, route, params = split_api_url(url)
+    params.update(extra_params or {})
+
+    return api_get(route, params, host=host, use_cache=use_cache)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Worker threads for the async api. Its size is the in-flight limit"""
+    global _executor
+
+    if _executor is None:
+        with _session_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT, thread_name_prefix="api")
+
+    return _executor
+
+
+async def api_get_async(route, params=None, host=None, timeout=None, use_cache=True) -> dict:
+    """api_get for coroutines. At most MAX_IN_FLIGHT requests run at once, the rest wait their turn"""
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(get_executor(), functools.partial(api_get, route, params, host, timeout, use_cache))
+
+
+async def gather_bounded(coros, limit=None, return_exceptions=False) -> list:
+    """asyncio.gather with at most limit coroutines running at the same time. Results keep the input order"""
+    semaphore = asyncio.Semaphore(limit or MAX_IN_FLIGHT)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros), return_exceptions=return_exceptions)
+
+
+def run_sync(coro):
+    """Run a coroutine to completion from synchronous code"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    # already inside an event loop (e.g. a notebook), so run it on a helper thread
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
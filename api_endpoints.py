@@ -0,0 +1,122 @@
+"""Pool of NeteaseCloudMusicApi replicas with health checks and least-outstanding-requests routing"""
+
+import random
+import threading
+import time
+
+EJECT_AFTER_FAILURES = 3 #consecutive failed requests before a replica is taken out of rotation
+MIN_EJECT_SECONDS = 30 #an ejected replica stays out at least this long
+HEALTH_CHECK_INTERVAL = 10 #seconds between health checks of all replicas
+HEALTH_CHECK_ROUTE = '' #the api root answers with 200 when the node server is up
+
+
+class Endpoint():
+    def __init__(self, host):
+        self.host = host.rstrip('/')
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.ejected_at = 0.0
+
+
+class EndpointPool():
+    def __init__(self, hosts, check=None, health_check_interval=HEALTH_CHECK_INTERVAL):
+        """check(host) -> bool is called by the health check thread, by default a GET on HEALTH_CHECK_ROUTE"""
+        if not hosts:
+            raise ValueError("EndpointPool needs at least one api host")
+
+        self.endpoints = {host.rstrip('/'): Endpoint(host) for host in hosts}
+        self.check = check
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+        self.health_thread = None
+        self.stopped = threading.Event()
+
+
+    def __contains__(self, host) -> bool:
+        return host is not None and host.rstrip('/') in self.endpoints
+
+
+    def acquire(self) -> str:
+        """Pick the healthy replica with the fewest requests on the wire and count one more for it"""
+        self.start_health_checks()
+
+        with self.lock:
+            candidates = [endpoint for endpoint in self.endpoints.values() if endpoint.healthy]
+            if not candidates:
+                # every replica is ejected, trying the one ejected longest ago beats failing outright
+                candidates = [min(self.endpoints.values(), key=lambda endpoint: endpoint.ejected_at)]
+
+            fewest = min(endpoint.outstanding for endpoint in candidates)
+            endpoint = random.choice([endpoint for endpoint in candidates if endpoint.outstanding == fewest])
+            endpoint.outstanding += 1
+
+            return endpoint.host
+
+
+    def release(self, host, ok=True) -> None:
+        """Report how the request to host went. Replicas failing EJECT_AFTER_FAILURES times in a row are ejected"""
+        with self.lock:
+            endpoint = self.endpoints[host.rstrip('/')]
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+
+            if ok:
+                endpoint.consecutive_failures = 0
+                return
+
+            endpoint.consecutive_failures += 1
+            if endpoint.healthy and endpoint.consecutive_failures >= EJECT_AFTER_FAILURES:
+                self.eject(endpoint)
+
+
+    def eject(self, endpoint) -> None:
+        print("ejecting api replica", endpoint.host)
+        endpoint.healthy = False
+        endpoint.ejected_at = time.time()
+
+
+    def readmit(self, endpoint) -> None:
+        print("re-admitting api replica", endpoint.host)
+        endpoint.healthy = True
+        endpoint.consecutive_failures = 0
+
+
+    def run_health_checks(self) -> None:
+        """Eject replicas failing their check, re-admit ejected ones that pass after MIN_EJECT_SECONDS"""
+        for endpoint in list(self.endpoints.values()):
+            try:
+                is_up = self.check(endpoint.host)
+            except Exception:
+                is_up = False
+
+            with self.lock:
+                if endpoint.healthy and not is_up:
+                    self.eject(endpoint)
+                elif not endpoint.healthy and is_up and time.time() - endpoint.ejected_at >= MIN_EJECT_SECONDS:
+                    self.readmit(endpoint)
+
+
+    def start_health_checks(self) -> None:
+        # a single replica has nowhere else to route to, so there is nothing to check
+        if self.health_thread is not None or self.check is None or len(self.endpoints) < 2:
+            return
+
+        with self.lock:
+            if self.health_thread is None:
+                self.health_thread = threading.Thread(target=self.health_loop, name="api-health", daemon=True)
+                self.health_thread.start()
+
+
+    def health_loop(self) -> None:
+        while not self.stopped.wait(self.health_check_interval):
+            self.run_health_checks()
+
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+    def status(self) -> list[dict]:
+        with self.lock:
+            return [{"host": endpoint.host, "healthy": endpoint.healthy, "outstanding": endpoint.outstanding,
+                     "consecutive_failures": endpoint.consecutive_failures} for endpoint in self.endpoints.values()]
@@ -0,0 +1,114 @@
+"""Per-route latency tracking, hedged requests and circuit breakers for the API client"""
+
+import threading
+import time
+from collections import deque
+import requests
+
+LATENCY_WINDOW = 500 #latest latencies kept per route
+HEDGE_MIN_SAMPLES = 20 #no hedging until the route has this many samples
+HEDGE_PERCENTILE = 95 #a request that is slower than this percentile is abandoned and sent again
+HEDGE_MIN_DELAY = 0.05 #seconds, never hedge faster than this
+HEDGED_ROUTES = ('comment/event', 'lyric') #routes with long latency tails
+
+FAILURE_THRESHOLD = 5 #consecutive failures that open a route's circuit
+OPEN_SECONDS = 30 #an open circuit fails fast this long, then lets one trial request through
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of sending a request to a route that keeps failing"""
+
+
+class LatencyTracker():
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+
+    def record(self, route, seconds) -> None:
+        with self.lock:
+            if route not in self.samples:
+                self.samples[route] = deque(maxlen=self.window)
+            self.samples[route].append(seconds)
+
+
+    def percentile(self, route, percentile):
+        """None while the route has fewer than HEDGE_MIN_SAMPLES samples"""
+        with self.lock:
+            samples = sorted(self.samples.get(route, ()))
+
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
+
+
+    def summary(self) -> dict:
+        return {route: {"p50": self.percentile(route, 50), "p95": self.percentile(route, 95), "p99": self.percentile(route, 99)}
+                for route in list(self.samples)}
+
+
+class CircuitBreaker():
+    """closed -> open after FAILURE_THRESHOLD failures in a row -> half open after OPEN_SECONDS -> closed on a success"""
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, open_seconds=OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+
+    def before_call(self, route) -> None:
+        with self.lock:
+            if self.opened_at is None:
+                return
+
+            if time.time() - self.opened_at < self.open_seconds or self.trial_running:
+                raise CircuitOpenError(f"circuit open for {route}, failing fast")
+
+            # half open, this caller is the trial request
+            self.trial_running = True
+
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+
+    def record_failure(self, route) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial_running:
+                    print("opening circuit for", route)
+                self.opened_at = time.time()
+            self.trial_running = False
+
+
+def is_route_failure(error) -> bool:
+    """Server side trouble counts against the route, a 404 or bad parameter does not"""
+    if isinstance(error, CircuitOpenError):
+        return False
+
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status == 429
+
+    return isinstance(error, requests.exceptions.RequestException)
+
+
+def hedged_call(send, hedge_after, can_hedge=None):
+    """Run send(read_timeout) on the caller's thread. With hedge_after, a send that has not answered after that many
+    seconds is abandoned and sent once more with the full timeout (send(None)), unless can_hedge() says no"""
+    if hedge_after is None or (can_hedge is not None and not can_hedge()):
+        return send(None)
+
+    try:
+        return send(max(HEDGE_MIN_DELAY, hedge_after))
+    except requests.exceptions.ReadTimeout:
+        return send(None)
@@ -8,7 +8,8 @@ import math
 import datetime
 
 from tqdm import tqdm
-from misc import get_album_details, get_song_details, get_comments, get_follower_count
+from misc import get_album_metadata, get_song_details, get_comments, get_comments_async, get_follower_count, API_HOST
+from api_client import gather_bounded, run_sync
 from find_artists_t1 import get_all_artists_for_name
 from catalog_search_t2 import get_all_artist_songs, get_song_size
 
@@ -21,11 +22,11 @@ ARTIST_NAME = "Two Steps From Hell"
 ARTIST_ID = 102714
 # ARTIST_ID = 185871
 
-API_HOST = 'http://18.119.235.232:3000'
 NETEASE_PROFILE = 'https://music.163.com/#/artist?id=185871'
 
 #https://music.163.com/#/artist?id=185871
 ARTIST_NAME = ARTIST_NAME.lower()
+COMMENT_WORKERS = 32 #comment requests in flight at the same time
 #ignore the profile link generation error
 warnings.simplefilter(action="ignore", category=SettingWithCopyWarning)
 
@@ -128,18 +129,19 @@ class AuditGenerator():
         album_set = set(self.audit_df["album_id"].to_list()) - {0} 
 
         albums_dict = {}
-        for album_id in tqdm(album_set):
-            if album_id not in albums_dict:
-                albums_dict[album_id] = {}
-                
-            try:
-                album_dict = get_album_details(album_id)
-                albums_dict[album_id]["album_name"] = album_dict["album"]["name"]
-                albums_dict[album_id]["company"] = album_dict["album"]["company"]
-                albums_dict[album_id]["release_date"] = self.convert_time_to_date(album_dict["album"]["publishTime"]/1000)
-            except Exception as e:
-                print("no album details", e)
-                albums_dict = {"album_name": "N/A", "company": "N/A", "release_date": None}
+        album_metadata = get_album_metadata(album_set)
+        for album_id in album_set:
+            # a failed album only loses its own details
+            if album_id not in album_metadata:
+                albums_dict[album_id] = {"album_name": "N/A", "company": "N/A", "release_date": None}
+                continue
+            
+            album = album_metadata[album_id]
+            albums_dict[album_id] = {
+                "album_name": album["album_name"],
+                "company": album["company"],
+                "release_date": self.convert_time_to_date(album["publish_time"]/1000),
+            }
 
         for album_id in album_set:
             try:
@@ -150,16 +152,47 @@ class AuditGenerator():
                 pass
             
     
-    def add_artists_and_comments_to_songs(self) -> None:
-        #TODO: test speed improvement with threading
+    def get_comment_count(self, song_id):
+        try:
+            return get_comments(song_id)["total"]
+        except Exception as e:
+            print("no comment count", song_id, e)
+            return "N/A"
+        
+    
+    async def get_comment_counts_async(self, song_ids, workers=COMMENT_WORKERS) -> dict:
+        """Comment totals for all song_ids with at most workers requests in flight. Failed songs get N/A"""
+        progress = tqdm(total=len(song_ids))
+        
+        async def comment_count(song_id):
+            try:
+                return (await get_comments_async(song_id))["total"]
+            except Exception as e:
+                print("no comment count", song_id, e)
+                return "N/A"
+            finally:
+                progress.update(1)
+        
+        counts = await gather_bounded([comment_count(song_id) for song_id in song_ids], workers)
+        progress.close()
+        
+        return dict(zip(song_ids, counts))
+        
+    
+    def add_artists_and_comments_to_songs(self, concurrent=True, workers=COMMENT_WORKERS) -> None:
         song_set = set(self.audit_df["song_id"].astype(str).to_list())
         songs_dict = {}
         
-        for song in tqdm(get_song_details(song_set)["songs"]):
+        songs = get_song_details(song_set)["songs"]
+        if concurrent:
+            comment_counts = run_sync(self.get_comment_counts_async([song["id"] for song in songs], workers))
+        else:
+            comment_counts = {song["id"]: self.get_comment_count(song["id"]) for song in tqdm(songs)}
+        
+        for song in songs:
             song_id = song["id"]
             artists = [(artist["id"], artist["name"])  for artist in song["ar"]]
-            comment_count = get_comments(song_id)["total"]
-            songs_dict[song_id] = {"comment_count": comment_count, "artists": artists} 
+            songs_dict[song_id] = {"comment_count": comment_counts[song_id], "artists": artists} 
         
         self.audit_df["comment_count"] = 0
         self.audit_df["artists"] = None
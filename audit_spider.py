@@ -1,8 +1,84 @@
 """Get audit data for songs with score > 5 and save to db"""
 
-from catalog_search_t2 import get_all_artist_songs
-import psycopg2
-from misc import DB_PARAMS
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from catalog_search_t2 import fetch_artist_catalog, catalog_insertion_query, refresh_catalogs, PAGE_WORKERS, REFRESH_HOURS
+from misc import DB_PARAMS, query
+from work_queue import WorkQueue, make_worker_id
+from migrations import migrate
+
+ARTIST_BATCH_SIZE = 20 #artists leased per claim
+CRAWL_PROCESSES = 4 #crawler processes, each one drains the same artist queue
+ARTIST_WORKERS = 4 #artists crawled at the same time in one process
+FLAG_BATCH_SIZE = 50 #finished artists flagged per update
+
+
+def crawl_artist(artist_id, page_workers=PAGE_WORKERS) -> int:
+    """Fetch and write one artist's catalog, returns the number of new songs. The finished flag is left to the caller"""
+    catalog = fetch_artist_catalog(artist_id, page_workers)
+
+    return catalog_insertion_query(catalog, finished_artist_ids=())
+
+
+def crawl_shard(shard, artist_workers=ARTIST_WORKERS, page_workers=PAGE_WORKERS, flag_batch_size=FLAG_BATCH_SIZE) -> dict:
+    """One crawler process: keeps artist_workers artists in flight, a new one is leased as soon as one finishes.
+    Finished artists are flagged flag_batch_size at a time, a crash only means their songs are crawled again.
+    A failed artist keeps its lease until it expires, so it is not crawled again right away"""
+    summary = {"shard": shard, "artists": 0, "songs": 0, "errors": 0, "seconds": 0.0}
+    started = time.time()
+    finished = []
+
+    with WorkQueue("audit_artists_to_scrape", worker_id=f"{make_worker_id()}:shard{shard}", db_params=DB_PARAMS) as work_queue, \
+            ThreadPoolExecutor(max_workers=artist_workers) as pool:
+        futures = {}
+        drained = False
+        try:
+            while True:
+                if not drained and len(futures) < artist_workers:
+                    artist_ids = work_queue.claim(artist_workers - len(futures))
+                    drained = not artist_ids
+                    for artist_id in artist_ids:
+                        futures[pool.submit(crawl_artist, artist_id, page_workers)] = artist_id
+
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    artist_id = futures.pop(future)
+                    try:
+                        summary["songs"] += future.result()
+                        summary["artists"] += 1
+                        finished.append(artist_id)
+                    except Exception as e:
+                        print("shard", shard, "artist", artist_id, "failed:", e)
+                        summary["errors"] += 1
+                        work_queue.defer([artist_id], e)
+
+                if len(finished) >= flag_batch_size:
+                    work_queue.complete(finished)
+                    finished = []
+        finally:
+            if finished:
+                work_queue.complete(finished)
+
+    summary["seconds"] = time.time() - started
+    return summary
+
+
+def print_crawl_summary(summaries, seconds) -> None:
+    for summary in summaries:
+        print("shard {shard}: {artists} artists, {songs} songs, {errors} errors in {seconds:.0f}s".format(**summary))
+
+    artists = sum(summary["artists"] for summary in summaries)
+    songs = sum(summary["songs"] for summary in summaries)
+    errors = sum(summary["errors"] for summary in summaries)
+    print(f"total: {artists} artists, {songs} songs, {errors} errors in {seconds:.0f}s, "
+          f"{artists / max(seconds, 1e-9):.2f} artists/s, {songs / max(seconds, 1e-9):.1f} songs/s")
+
 
 class AuditSpider():
     def __init__(self):
@@ -13,21 +89,73 @@ class AuditSpider():
         pass
     #
     
-    def add_song_data(self):
-        """run task 2"""
-        conn = psycopg2.connect(**DB_PARAMS)
-        cursor = conn.cursor()
-        
-        cursor.execute("""SELECT * from audit_artists_to_scrape WHERE finished=FALSE""")
-        artist_ids = [x[0] for x in cursor.fetchall()]
-        
-        get_all_artist_songs(artist_ids, create_dataframe=False)
-        
-        cursor.close()
-        conn.close()
+    def add_song_data(self, batch_size=ARTIST_BATCH_SIZE):
+        """run task 2, artists are leased from audit_artists_to_scrape so several spiders can share the queue.
+        Every artist is crawled on its own, a failed artist keeps its lease until it expires and does not hold back the rest"""
+        with WorkQueue("audit_artists_to_scrape", db_params=DB_PARAMS) as work_queue:
+            for artist_ids in work_queue.batches(batch_size):
+                untried = list(artist_ids)
+                try:
+                    while untried:
+                        artist_id = untried.pop(0)
+                        try:
+                            crawl_artist(artist_id)
+                            work_queue.complete([artist_id])
+                            print("artist_id:", artist_id)
+                        except Exception as e:
+                            print("artist", artist_id, "failed:", e)
+                            work_queue.defer([artist_id], e)
+                finally:
+                    # interrupted, the artists not crawled yet get their attempt back
+                    if untried:
+                        work_queue.release(untried, refund_attempt=True)
+
+    
+    def crawl_catalogs(self, processes=CRAWL_PROCESSES, artist_workers=ARTIST_WORKERS, page_workers=PAGE_WORKERS,
+                       flag_batch_size=FLAG_BATCH_SIZE) -> list[dict]:
+        """run task 2 on processes crawler processes, the artists are split between them by the work queue"""
+        started = time.time()
+        shard_args = [(shard, artist_workers, page_workers, flag_batch_size) for shard in range(processes)]
+
+        if processes == 1:
+            summaries = [crawl_shard(*shard_args[0])]
+        else:
+            # spawn, so no process inherits the parent's connection pool or client threads
+            with multiprocessing.get_context("spawn").Pool(processes) as pool:
+                results = [pool.apply_async(crawl_shard, args) for args in shard_args]
+                summaries = []
+                for shard, result in enumerate(results):
+                    try:
+                        summaries.append(result.get())
+                    except Exception as e:
+                        print("shard", shard, "crashed:", e)
+                        summaries.append({"shard": shard, "artists": 0, "songs": 0, "errors": 1, "seconds": 0.0})
+
+        print_crawl_summary(summaries, time.time() - started)
+        return summaries
+
+
+    def refresh_song_data(self, page_workers=PAGE_WORKERS, refresh_hours=REFRESH_HOURS) -> dict:
+        """Incremental re-run of task 2 for every monitored artist, finished or not"""
+        artist_ids = [x[0] for x in query(DB_PARAMS, "SELECT artist_id FROM audit_artists_to_scrape")]
+
+        return refresh_catalogs(artist_ids, page_workers, refresh_hours)
         
         
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl the catalogs of all artists in audit_artists_to_scrape")
+    parser.add_argument("--processes", type=int, default=CRAWL_PROCESSES, help="crawler processes")
+    parser.add_argument("--artist-workers", type=int, default=ARTIST_WORKERS, help="artists crawled at once per process")
+    parser.add_argument("--page-workers", type=int, default=PAGE_WORKERS, help="catalog pages requested at once per artist")
+    parser.add_argument("--flag-batch-size", type=int, default=FLAG_BATCH_SIZE, help="finished artists flagged per update")
+    parser.add_argument("--refresh", action="store_true", help="only fetch what changed since the last crawl of every artist")
+    parser.add_argument("--refresh-hours", type=float, default=REFRESH_HOURS, help="skip artists refreshed more recently")
+    args = parser.parse_args()
+
+    migrate(DB_PARAMS)
     audit_spider = AuditSpider()
-    audit_spider.add_song_data()
+    if args.refresh:
+        audit_spider.refresh_song_data(args.page_workers, args.refresh_hours)
+    else:
+        audit_spider.crawl_catalogs(args.processes, args.artist_workers, args.page_workers, args.flag_batch_size)
     
@@ -0,0 +1,140 @@
+"""Bulk writes: COPY through a temporary staging table for large loads, execute_values batches for the search tasks"""
+
+import datetime
+import itertools
+import json
+import uuid
+
+from psycopg2.extras import execute_values
+
+from db_pool import transaction
+
+INSERT_PAGE_SIZE = 500 #rows per multi-row INSERT statement and commit
+
+COPY_NULL = '\\N'
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def sanitize_text(value: str) -> str:
+    """postgres text cannot hold NUL bytes or lone surrogates"""
+    return value.replace('\x00', '\uFFFD').encode('utf-8', errors='replace').decode('utf-8')
+
+
+def jsonb_text(value, **dumps_args) -> str:
+    """json.dumps for jsonb columns, jsonb rejects the \\u0000 escape that a NUL in a string turns into"""
+    return sanitize_text(json.dumps(value, ensure_ascii=False, **dumps_args).replace('\\u0000', '\\ufffd'))
+
+
+def to_array_literal(values) -> str:
+    items = []
+    for value in values:
+        if value is None:
+            items.append('NULL')
+        else:
+            items.append('"' + sanitize_text(str(value)).replace('\\', '\\\\').replace('"', '\\"') + '"')
+
+    return '{' + ','.join(items) + '}'
+
+
+def to_copy_value(value) -> str:
+    """One field in COPY text format"""
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (list, tuple)):
+        value = to_array_literal(value)
+    elif isinstance(value, dict):
+        value = jsonb_text(value)
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    else:
+        value = str(value)
+
+    return sanitize_text(value).translate(COPY_ESCAPES)
+
+
+class CopyStream():
+    """File-like object for cursor.copy_expert that encodes rows only as postgres reads them"""
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.row_count = 0
+
+
+    def read(self, size=-1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.buffer += '\t'.join(to_copy_value(value) for value in row) + '\n'
+            self.row_count += 1
+
+        if size < 0:
+            chunk, self.buffer = self.buffer, ''
+        else:
+            chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return chunk
+
+
+    def readline(self, size=-1) -> str:
+        return self.read(size)
+
+
+def copy_to_staging(cursor, table, columns, rows) -> str:
+    """Stream rows into a new temp table with the column types of table. Returns the staging table name"""
+    staging = f"staging_{table}_{uuid.uuid4().hex[:8]}"
+    column_list = ', '.join(columns)
+
+    # only the loaded columns and no constraints, the target checks those during the merge
+    cursor.execute(f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {column_list} FROM {table} WITH NO DATA")
+    cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN", CopyStream(rows))
+
+    return staging
+
+
+def bulk_upsert(cursor, table, columns, rows, conflict="ON CONFLICT DO NOTHING", extra_values=None) -> int:
+    """COPY rows into a staging table, then INSERT ... SELECT into table with the given conflict clause.
+    extra_values maps additional target columns to sql expressions, e.g. {'scrape_time': 'NOW()'}.
+    Runs in the caller's transaction and returns the number of inserted rows"""
+    extra_values = extra_values or {}
+    staging = copy_to_staging(cursor, table, columns, rows)
+
+    target_columns = ', '.join(list(columns) + list(extra_values))
+    select_columns = ', '.join(list(columns) + list(extra_values.values()))
+    cursor.execute(f"INSERT INTO {table} ({target_columns}) SELECT {select_columns} FROM {staging} {conflict}")
+
+    return cursor.rowcount
+
+
+def bulk_update_flags(cursor, table, key_column, keys, set_clause) -> int:
+    """UPDATE table SET set_clause for every row whose key_column is in keys, e.g. the *_finished flags"""
+    staging = copy_to_staging(cursor, table, [key_column], ((key,) for key in keys))
+    cursor.execute(f"""
+        UPDATE {table} AS t SET {set_clause}
+        FROM {staging} AS c
+        WHERE c.{key_column} = t.{key_column}""")
+
+    return cursor.rowcount
+
+
+def iter_batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def batched_insert(insert_query, rows, page_size=INSERT_PAGE_SIZE, db_params=None) -> int:
+    """Run an 'INSERT ... VALUES %s' query for all rows as multi-row statements of page_size rows,
+    with one commit per batch. Returns the number of inserted rows"""
+    inserted = 0
+    for batch in iter_batches(rows, page_size):
+        with transaction(db_params) as cursor:
+            execute_values(cursor, insert_query, batch, page_size=page_size)
+            inserted += max(cursor.rowcount, 0)
+
+    return inserted
@@ -1,35 +1,38 @@
 """Find all songs for given artist_id from find_artists_t1"""
 
+import datetime
 import pandas as pd
 import psycopg2
-import requests, json
+import requests
 
-from misc import create_table, DB_PARAMS, API_HOST, NETEASE_PROFILE
+from misc import DB_PARAMS, API_HOST, NETEASE_PROFILE
+from db_pool import transaction
+from bulk_loader import bulk_upsert, bulk_update_flags, jsonb_text
+from migrations import migrate
+from api_client import api_get_url, api_get_async, split_api_url, gather_bounded, run_sync
+
+PAGE_SIZE = 100 #max songs the artist/songs route returns per request
+PAGE_WORKERS = 16 #catalog pages requested at the same time
+REFRESH_ORDER = 'time' #artist/songs order while refreshing, the newest songs are on the first pages
+REFRESH_HOURS = 20 #artists refreshed more recently than this are skipped
 
 
 def query_artist_ids():
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-    
     # SQL query to select all artist IDs
     select_query = "SELECT artist_id, search_term FROM artist;"
     
     try:
-        # Execute the SQL query
-        cursor.execute(select_query)
+        # Execute the SQL query on a pooled connection
+        with transaction(DB_PARAMS) as cursor:
+            cursor.execute(select_query)
         
-        # Fetch all the results
-        artist_ids = cursor.fetchall()
+            # Fetch all the results
+            artist_ids = cursor.fetchall()
         
         return artist_ids[0][1], [i[0] for i in artist_ids]
             
     except psycopg2.Error as e:
         print(f"An error occurred: {e}")
-    finally:
-        # Close the cursor and the connection
-        cursor.close()
-        conn.close()
 
 
 def get_song_size(artist_id, api_url):
@@ -37,10 +40,9 @@ def get_song_size(artist_id, api_url):
         # make a request to the songs route to find total songs
         path = '/'.join([api_url, 'artist/songs?id=' + str(artist_id)])
         print(path)
-        result = requests.get(path)
-        result.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
+        result = api_get_url(path)
         
-        return path, int(result.json()["total"])
+        return path, int(result["total"])
     
     except requests.exceptions.HTTPError as http_err:
         raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
@@ -48,20 +50,40 @@ def get_song_size(artist_id, api_url):
         raise Exception(f"Error fetching profile: {err}")  # Other request issues
 
 
-def get_catalog_dict(offset, parent_path) -> dict:
+def get_catalog_dict(offset, parent_path, order=None, use_cache=True) -> dict:
+    params = {'offset': offset, 'limit': PAGE_SIZE}
+    if order is not None:
+        params['order'] = order
     try:
         # make a request to the songs route to find total songs
-        path = '&'.join([parent_path, 'offset=' + str(offset) + '&limit=100'])
-        result = requests.get(path)
-        result.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
-        
-        return result.json()
+        return api_get_url(parent_path, params, use_cache=use_cache)
 
     except requests.exceptions.HTTPError as http_err:
         raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
     except requests.exceptions.RequestException as err:
         raise Exception(f"Error fetching profile: {err}")  # Other request issues
 
+
+async def get_catalog_dict_async(offset, parent_path, order=None, use_cache=True) -> dict:
+    host, route, params = split_api_url(parent_path)
+    params.update({'offset': offset, 'limit': PAGE_SIZE})
+    if order is not None:
+        params['order'] = order
+    try:
+        return await api_get_async(route, params, host=host, use_cache=use_cache)
+
+    except requests.exceptions.HTTPError as http_err:
+        raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
+    except requests.exceptions.RequestException as err:
+        raise Exception(f"Error fetching profile: {err}")  # Other request issues
+
+
+def get_catalog_pages(parent_path, size, workers=PAGE_WORKERS, order=None, use_cache=True) -> list[dict]:
+    """Request every page of the catalog at once (at most workers in flight), pages are returned in offset order"""
+    offsets = range(0, size, PAGE_SIZE)
+    
+    return run_sync(gather_bounded([get_catalog_dict_async(offset, parent_path, order, use_cache) for offset in offsets], workers))
+
     
 def catalog_clean(data: dict) -> list[dict]:
     
@@ -93,14 +115,13 @@ def catalog_clean(data: dict) -> list[dict]:
     return extracted_data
     
 
-def catalog_insertion_query(catalog_li, netease_profile=None, search_term=None):
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-    
+def catalog_insertion_query(catalog_li, netease_profile=None, search_term=None, finished_artist_ids=None):
+    """COPY the catalog through staging tables, the songs, their json and the finished flags commit together.
+    finished_artist_ids are flagged as finished, by default every credited artist. Returns the number of new songs"""
     audit_songs_args = []
     audit_json_args = []
-    audit_finished_args = []
+    audit_finished_args = set()
+    seen_song_ids = set()
     
     # Prepare data for insertion (assuming the search_term and artist_search_user_profile are known)
     search_term = search_term
@@ -117,95 +138,55 @@ def catalog_insertion_query(catalog_li, netease_profile=None, search_term=None):
         mst = catalog['mst']
         cp = catalog['copyright_id']
         no = catalog['no']
-        json_string = json.dumps(catalog['json_string'])
+        audit_finished_args.add(artist_id)
+        
+        # catalog_clean repeats the song for every artist credit, only the first one is written
+        if song_id in seen_song_ids:
+            continue
+        seen_song_ids.add(song_id)
+        json_string = jsonb_text(catalog['json_string'])
         
         audit_songs_args.append((song_id, song_name, artist_name, artist_id, fee, pop, mst, cp, no))
         audit_json_args.append((-1, song_id, json_string))
-        audit_finished_args.append((artist_id,))
-        
-    audit_songs_args_str = ','.join(cursor.mogrify("(%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())", x).decode('utf-8') for x in audit_songs_args)
-    audit_json_args_str = ','.join(cursor.mogrify("(%s, %s, %s)", x).decode('utf-8') for x in audit_json_args)
-    audit_finished_str = ','.join(cursor.mogrify("(%s)", x).decode('utf-8') for x in audit_finished_args)
         
     try:
-        cursor.execute(f"""
-            INSERT INTO audit_songs (song_id, song_name, artist_name, artist_id, fee, popularity,
-                mst, copyright_id, no, scrape_time 
-            ) VALUES {audit_songs_args_str} ON CONFLICT (song_id) DO NOTHING;""")
-        conn.commit()
-        
-        cursor.execute(f"""
-            INSERT INTO audit_json (artist_id, song_id, api_text)
-            VALUES {audit_json_args_str} ON CONFLICT DO NOTHING;""")
-        conn.commit()
-        
-        cursor.execute(f"""
-            update audit_artists_to_scrape as t set
-            finished = True
-            from (values
-                {audit_finished_str}
-            ) as c(artist_id) 
-            where c.artist_id = t.artist_id;
-        """)
-        conn.commit()
+        with transaction(DB_PARAMS) as cursor:
+            inserted = bulk_upsert(cursor, "audit_songs",
+                                   ["song_id", "song_name", "artist_name", "artist_id", "fee", "popularity", "mst", "copyright_id", "no"],
+                                   audit_songs_args, "ON CONFLICT (song_id) DO NOTHING", {"scrape_time": "NOW()"})
+            
+            bulk_upsert(cursor, "audit_json", ["artist_id", "song_id", "api_text"], audit_json_args)
+            
+            if finished_artist_ids is not None:
+                audit_finished_args = finished_artist_ids
+            if audit_finished_args:
+                bulk_update_flags(cursor, "audit_artists_to_scrape", "artist_id", audit_finished_args, "finished = True")
 
     except psycopg2.DatabaseError as error:
         print("error: ", error)
-        conn.rollback()
+        raise
 
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
+    return inserted
 
     
 def create_t2_tables():#
-    create_table(DB_PARAMS,
-        """
-            CREATE TABLE IF NOT EXISTS audit_songs (
-                search_term TEXT,
-                song_id BIGINT PRIMARY KEY,
-                song_name TEXT,
-                tns TEXT,
-                artist_name TEXT,
-                artist_id BIGINT,
-                                fee INTEGER,
-                popularity INTEGER,
-                mst INTEGER,
-                copyright_id BIGINT,
-                no INTEGER,
-                scrape_time TIMESTAMP
-            );
-        """
-        )
-        
-    #The id that is not used should be -1
-    create_table(DB_PARAMS,
-        """
-            CREATE TABLE IF NOT EXISTS audit_json (
-                artist_id bigint NOT NULL,
-                song_id bigint NOT NULL,
-                api_text jsonb,
-                CONSTRAINT audit_json_pkey PRIMARY KEY (artist_id, song_id)
-            );
-        """
-        )
-
-
-def get_all_artist_songs(artist_ids, skip_duplicates=False, search_term=None, create_dataframe=True):
-    # create_t2_tables()
+    migrate(DB_PARAMS)
+
+
+def fetch_artist_catalog(artist_id, page_workers=PAGE_WORKERS) -> list[dict]:
+    path, size = get_song_size(artist_id, API_HOST)
     cleaned_catalog_list = []
-    
-    for artist_id in artist_ids:
-        path, size = get_song_size(artist_id, API_HOST)
-        # access the catalogs
-        counter = 0
-        
-        #TODO: better use pagination
-        while counter < size + 100:
-            data_dict = get_catalog_dict(counter, path)
-            cleaned_catalog_list += catalog_clean(data_dict)
+    # access the catalogs, all pages are known from the total so fetch them concurrently
+    for data_dict in get_catalog_pages(path, size, page_workers):
+        cleaned_catalog_list += catalog_clean(data_dict)
 
-            counter += 100
+    return cleaned_catalog_list
+
+
+def get_all_artist_songs(artist_ids, skip_duplicates=False, search_term=None, create_dataframe=True, page_workers=PAGE_WORKERS):
+    # create_t2_tables()
+    for artist_id in artist_ids:
+        cleaned_catalog_list = fetch_artist_catalog(artist_id, page_workers)
 
         if create_dataframe:
             catalog_df = pd.DataFrame.from_dict(cleaned_catalog_list)
@@ -213,14 +194,130 @@ def get_all_artist_songs(artist_ids, skip_duplicates=False, search_term=None, cr
             print(catalog_df)
             return catalog_df
             
-        # injection into postgres
-        # catalog_insertion_query(cleaned_catalog_list, search_term=search_term)
-        cleaned_catalog_list = []
+        # injection into postgres, the crawled artist is finished together with its songs
+        catalog_insertion_query(cleaned_catalog_list, search_term=search_term, finished_artist_ids=[artist_id])
         print("artist_id:", artist_id)
     
     print("task 2 complete")
     
 
+def get_live_total(artist_id) -> tuple[str, int]:
+    """get_song_size without the response cache and with a single song, a refresh needs today's total"""
+    path = '/'.join([API_HOST, 'artist/songs?id=' + str(artist_id)])
+    result = api_get_url(path, {'limit': 1}, use_cache=False)
+    
+    return path, int(result["total"])
+
+
+def known_catalog_totals(artist_ids) -> dict:
+    """artist_id -> (total, refreshed_at) recorded by the last refresh,
+    for artists that were never refreshed the songs stored under them in audit_songs"""
+    with transaction(DB_PARAMS) as cursor:
+        cursor.execute("""
+            SELECT a.artist_id, COALESCE(c.total, s.songs), COALESCE(c.refreshed_at, s.scrape_time)
+            FROM unnest(%s::bigint[]) AS a(artist_id)
+            LEFT JOIN audit_artist_catalog c ON c.artist_id = a.artist_id
+            LEFT JOIN (
+                SELECT artist_id, COUNT(*) AS songs, MAX(scrape_time) AS scrape_time
+                FROM audit_songs WHERE artist_id = ANY(%s) GROUP BY artist_id
+            ) s ON s.artist_id = a.artist_id
+            WHERE c.total IS NOT NULL OR s.songs IS NOT NULL""", (list(artist_ids), list(artist_ids)))
+        
+        return {artist_id: (total, refreshed_at) for artist_id, total, refreshed_at in cursor.fetchall()}
+
+
+def record_catalog_total(artist_id, total) -> None:
+    with transaction(DB_PARAMS) as cursor:
+        cursor.execute("""
+            INSERT INTO audit_artist_catalog (artist_id, total, refreshed_at) VALUES (%s, %s, NOW())
+            ON CONFLICT (artist_id) DO UPDATE SET total = EXCLUDED.total, refreshed_at = EXCLUDED.refreshed_at""",
+            (artist_id, total))
+
+
+def unknown_song_ids(song_ids) -> set:
+    # read once, callers may pass a generator
+    song_ids = set(song_ids)
+    with transaction(DB_PARAMS) as cursor:
+        cursor.execute("SELECT song_id FROM audit_songs WHERE song_id = ANY(%s)", (list(song_ids),))
+        known = {row[0] for row in cursor.fetchall()}
+    
+    return song_ids - known
+
+
+def fetch_new_songs(parent_path, total, known_total, page_workers=PAGE_WORKERS) -> list[dict]:
+    """Newest first, only the pages that can hold the total - known_total new songs. Catalogs are not strictly
+    append only (back catalog releases, removed songs), so pages keep coming while the last one still had unknown songs"""
+    pages_needed = -(-max(total - known_total, 1) // PAGE_SIZE)
+    pages = get_catalog_pages(parent_path, min(pages_needed * PAGE_SIZE, total), page_workers, REFRESH_ORDER, use_cache=False)
+    
+    offset = pages_needed * PAGE_SIZE
+    while pages and offset < total and unknown_song_ids(song['id'] for song in pages[-1]['songs']):
+        pages.append(get_catalog_dict(offset, parent_path, REFRESH_ORDER, use_cache=False))
+        offset += PAGE_SIZE
+    
+    cleaned_catalog_list = []
+    for data_dict in pages:
+        cleaned_catalog_list += catalog_clean(data_dict)
+    
+    return cleaned_catalog_list
+
+
+def refresh_artist_catalog(artist_id, known_total=None, page_workers=PAGE_WORKERS) -> tuple[str, int]:
+    """Bring one artist's catalog up to date. Returns (what was done, new songs written)"""
+    path, total = get_live_total(artist_id)
+    
+    if known_total is not None and total == known_total:
+        record_catalog_total(artist_id, total)
+        return "unchanged", 0
+    
+    if known_total is None or total < known_total:
+        # never crawled, or songs were taken down and the new ones could be anywhere
+        mode = "full"
+        cleaned_catalog_list = []
+        for data_dict in get_catalog_pages(path, total, page_workers, use_cache=False):
+            cleaned_catalog_list += catalog_clean(data_dict)
+    else:
+        mode = "incremental"
+        cleaned_catalog_list = fetch_new_songs(path, total, known_total, page_workers)
+    
+    inserted = catalog_insertion_query(cleaned_catalog_list, finished_artist_ids=[artist_id])
+    record_catalog_total(artist_id, total)
+    
+    return mode, inserted
+
+
+def refresh_catalogs(artist_ids, page_workers=PAGE_WORKERS, refresh_hours=REFRESH_HOURS) -> dict:
+    """Incremental refresh: artists checked in the last refresh_hours are skipped without a request,
+    an unchanged total costs one request and only a changed catalog is fetched"""
+    known = known_catalog_totals(artist_ids)
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=refresh_hours)
+    summary = {"recent": 0, "unchanged": 0, "incremental": 0, "full": 0, "errors": 0, "new_songs": 0}
+    
+    for artist_id in artist_ids:
+        known_total, refreshed_at = known.get(artist_id, (None, None))
+        if refreshed_at is not None:
+            if refreshed_at.tzinfo is None:
+                refreshed_at = refreshed_at.replace(tzinfo=datetime.timezone.utc)
+            if refreshed_at >= cutoff:
+                summary["recent"] += 1
+                continue
+        
+        try:
+            mode, inserted = refresh_artist_catalog(artist_id, known_total, page_workers)
+        except Exception as e:
+            print("artist_id:", artist_id, "refresh failed:", e)
+            summary["errors"] += 1
+            continue
+        
+        summary[mode] += 1
+        summary["new_songs"] += inserted
+        if mode != "unchanged":
+            print("artist_id:", artist_id, mode, inserted, "new songs")
+    
+    print("refresh complete:", summary)
+    return summary
+    
+
 if __name__ == '__main__':
     # search_term, artist_ids = query_artist_ids()
     search_term, artist_ids = "Marshmello", [233338]
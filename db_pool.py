@@ -0,0 +1,98 @@
+"""Shared PostgreSQL connection pool for all insertion and query helpers"""
+
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+# Replace these variables with your database credentials
+DB_PARAMS = {
+    'database': 'netease_max',
+    'user': 'max',
+    'password': '123',
+    'host': 'cma.cps7ukarrgmb.us-east-1.rds.amazonaws.com',
+    'port': '5432'
+}
+
+MIN_CONNECTIONS = 1
+MAX_CONNECTIONS = 20 #also the limit of db helpers running at the same time, the others wait for a connection
+
+_pools = {}
+_slots = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_params=None) -> ThreadedConnectionPool:
+    """One pool per set of connection parameters, created on first use"""
+    db_params = db_params or DB_PARAMS
+    key = tuple(sorted(db_params.items()))
+
+    if key not in _pools:
+        with _pools_lock:
+            if key not in _pools:
+                _pools[key] = ThreadedConnectionPool(MIN_CONNECTIONS, MAX_CONNECTIONS, **db_params)
+                # getconn raises on an exhausted pool instead of waiting, callers queue on this semaphore first
+                _slots[key] = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+    return _pools[key]
+
+
+def get_slots(db_params=None) -> threading.BoundedSemaphore:
+    get_pool(db_params)
+    return _slots[tuple(sorted((db_params or DB_PARAMS).items()))]
+
+
+def close_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+        _slots.clear()
+
+
+@contextmanager
+def get_connection(db_params=None):
+    """Borrow a pooled connection. Anything left uncommitted is rolled back before it goes back to the pool"""
+    pool = get_pool(db_params)
+    slots = get_slots(db_params)
+    slots.acquire()
+    try:
+        conn = pool.getconn()
+    except BaseException:
+        slots.release()
+        raise
+
+    try:
+        yield conn
+    finally:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        # broken connections are dropped instead of handed to the next caller
+        pool.putconn(conn, close=bool(conn.closed))
+        slots.release()
+
+
+@contextmanager
+def transaction(db_params=None):
+    """Cursor inside one transaction: commits when the block finishes, rolls back if it raises"""
+    with get_connection(db_params) as conn:
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking db helper from async workers without stalling the event loop"""
+    return await asyncio.to_thread(functools.partial(fn, *args, **kwargs))
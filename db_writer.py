@@ -0,0 +1,134 @@
+"""Background writer: API fetching keeps going while rows are written to postgres on dedicated threads"""
+
+import queue
+import threading
+import time
+
+QUEUE_SIZE = 10000 #rows waiting to be written before producers block
+FLUSH_ROWS = 500 #rows per table that trigger a write
+FLUSH_SECONDS = 5.0 #rows are never held longer than this
+
+
+class WriteError(Exception):
+    """Raised by close when batches could not be written"""
+
+
+class BackgroundWriter():
+    """Producers put rows per table, writer threads group them and call the table's flush function.
+    A full queue blocks the producers, so fetching can never run away from the database"""
+    def __init__(self, writer_threads=1, queue_size=QUEUE_SIZE, flush_rows=FLUSH_ROWS, flush_seconds=FLUSH_SECONDS):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+
+        self.handlers = {}
+        self.buffers = {}
+        self.first_buffered_at = {}
+        self.lock = threading.Lock()
+
+        self.written = {}
+        self.errors = []
+        self.stopping = threading.Event()
+        self.threads = [threading.Thread(target=self.run, name=f"db-writer-{i}", daemon=True) for i in range(writer_threads)]
+        for thread in self.threads:
+            thread.start()
+
+
+    def register(self, table, flush_fn, flush_rows=None) -> None:
+        """flush_fn(rows) writes a list of rows for table, e.g. a batched_insert or songlyric_insertion_query"""
+        with self.lock:
+            self.handlers[table] = (flush_fn, flush_rows or self.flush_rows)
+            self.buffers.setdefault(table, [])
+            self.written.setdefault(table, 0)
+
+
+    def put(self, table, row) -> None:
+        if table not in self.handlers:
+            raise KeyError(f"no flush function registered for {table}")
+
+        # blocks while the queue is full, that is the backpressure on the producers
+        self.queue.put((table, row))
+
+
+    def put_many(self, table, rows) -> None:
+        for row in rows:
+            self.put(table, row)
+
+
+    def run(self) -> None:
+        while True:
+            try:
+                table, row = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    return
+                self.flush_due()
+                continue
+
+            batch = None
+            with self.lock:
+                buffer = self.buffers[table]
+                if not buffer:
+                    self.first_buffered_at[table] = time.monotonic()
+                buffer.append(row)
+
+                if len(buffer) >= self.handlers[table][1]:
+                    batch = self.take(table)
+
+            self.queue.task_done()
+            if batch:
+                self.write(table, batch)
+            self.flush_due()
+
+
+    def take(self, table) -> list:
+        """Swap out the table's buffer, call with self.lock held"""
+        batch = self.buffers[table]
+        self.buffers[table] = []
+
+        return batch
+
+
+    def flush_due(self, force=False) -> None:
+        now = time.monotonic()
+        with self.lock:
+            due = [(table, self.take(table)) for table, buffer in self.buffers.items()
+                   if buffer and (force or now - self.first_buffered_at[table] >= self.flush_seconds)]
+
+        for table, batch in due:
+            self.write(table, batch)
+
+
+    def write(self, table, batch) -> None:
+        flush_fn = self.handlers[table][0]
+        try:
+            flush_fn(batch)
+            with self.lock:
+                self.written[table] += len(batch)
+        except Exception as e:
+            # a failed batch must not stop the writer, close raises once everything else is written
+            print("db writer error", table, e)
+            self.errors.append((table, len(batch), e))
+
+
+    def close(self, raise_errors=True) -> None:
+        """Write everything still queued or buffered and stop the writer threads.
+        Raises WriteError if any batch was lost, so a task cannot finish with missing rows"""
+        self.queue.join()
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.flush_due(force=True)
+
+        if raise_errors and self.errors:
+            lost = sum(rows for table, rows, error in self.errors)
+            raise WriteError(f"{len(self.errors)} batches ({lost} rows) could not be written, first error: {self.errors[0][2]}")
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        # an exception from the with block is not replaced by the write errors
+        self.close(raise_errors=exc_type is None)
@@ -5,34 +5,27 @@
 Writes all artists with given or similar name to db"""
 
 # -*- coding: utf-8 -*-
-import psycopg2
 import requests, json
 import pandas as pd
 
-from misc import create_table, get_id_from_netease_url, DB_PARAMS, API_HOST, NETEASE_PROFILE
+from misc import get_id_from_netease_url, search, DB_PARAMS, API_HOST, NETEASE_PROFILE
+from api_client import api_get
+from bulk_loader import INSERT_PAGE_SIZE
+from payload_store import insert_with_payloads
+from migrations import migrate
 
 def get_artist_json_from_name(name) -> dict:
     """Get all artists for given name. Also includes similar rtists"""
-    path = '/'.join([API_HOST, 'search?keywords=' + name + '&type=100']) #type100 = search for artist
-    
-    result = requests.get(path)
-    result.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
-    
-    return result.json()
+    return search(name, 100) #type100 = search for artist
 
 
 def get_artist_json_from_link(profile_link):
     """find clear artist id from the actual link string"""
     artist_id = get_id_from_netease_url(profile_link)
-    # find the correct path
-    path = '/'.join([API_HOST, 'artists?id=' + artist_id])
     # access the artist-name search route
     try:
-        response = requests.get(path)
-        response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
-        
         # find the exact artist name
-        artist_name = response.json()["artist"]["name"]
+        artist_name = api_get('artists', {'id': artist_id})["artist"]["name"]
         
         return artist_name, get_artist_json_from_name(artist_name)
         
@@ -88,11 +81,7 @@ def append_trans_artists(data_dict, api_server):
     return data_dict
 
 
-def artists_insertion_query(data, artist_name, netease_profile, raw_json):
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-
+def artists_insertion_query(data, artist_name, netease_profile, raw_json, page_size=INSERT_PAGE_SIZE):
     # This is the SQL query template for inserting data
     insert_query = """
     INSERT INTO artist (
@@ -105,8 +94,8 @@ def artists_insertion_query(data, artist_name, netease_profile, raw_json):
         hlwords,
         albumsize,
         mvsize,
-        json_string
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        payload_hash
+    ) VALUES %s
     ON CONFLICT (artist_id) DO NOTHING;
     """
 
@@ -116,7 +105,8 @@ def artists_insertion_query(data, artist_name, netease_profile, raw_json):
     artistcount = data['artistcount']
     hlwords = json.dumps(data['hlWords'], ensure_ascii=False)  # Convert the list of words to JSON string
 
-    # Iterate over the artists and insert each one
+    # Iterate over the artists and collect one row each
+    rows = []
     for artist in data['artists']:
         artist_name = artist['artist_name']
         artist_id = artist['artist_id']
@@ -124,8 +114,7 @@ def artists_insertion_query(data, artist_name, netease_profile, raw_json):
         mvsize = artist['mvsize']
         trans = artist['trans']
 
-        # Execute the insert query with the data
-        cursor.execute(insert_query, (
+        rows.append((
             artist_search_user_profile,
             artist_name,
             artist_name,
@@ -135,34 +124,15 @@ def artists_insertion_query(data, artist_name, netease_profile, raw_json):
             hlwords,
             albumsize,
             mvsize,
-            json.dumps(raw_json, ensure_ascii=False),
+            raw_json, # one search response for every artist row, stored once in api_payload
         ))
 
-    # Commit the transaction
-    conn.commit()
-
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
+    # Execute the insert query with the data, page_size rows per statement
+    insert_with_payloads(insert_query, rows, page_size, DB_PARAMS)
 
 
 def create_t1_table():
-        create_table(DB_PARAMS,
-        """
-            CREATE TABLE IF NOT EXISTS artist (
-                artist_search_user_profile TEXT,
-                search_term TEXT,
-                artist_name TEXT,
-                artist_id BIGINT PRIMARY KEY,
-                trans TEXT,
-                artistcount INTEGER,
-                hlwords TEXT,
-                albumsize INTEGER,
-                mvsize INTEGER,
-                json_string TEXT
-            );
-        """
-    )
+    migrate(DB_PARAMS)
 
 
 def get_all_artists_for_name(profile) -> pd.DataFrame:
@@ -1,27 +1,23 @@
 """Search the API for all keywords from other tables: song_name, artist_name """
 
 import re
-import psycopg2
 import requests, json
 
-from misc import create_table, DB_PARAMS, API_HOST,NETEASE_PROFILE, query, clean_song_json
+from misc import DB_PARAMS, API_HOST,NETEASE_PROFILE, stream_query, clean_song_json
+from bulk_loader import INSERT_PAGE_SIZE
+from payload_store import insert_with_payloads
+from migrations import migrate
+from search_ledger import ledger_search, ledger_stats
+from db_writer import BackgroundWriter
 
 def get_raw_song_data(parent_path, search_term):
-    path = '/'.join([parent_path, "search?keywords=" + search_term])
+    result = ledger_search(search_term, host=parent_path)
     
-    result = requests.get(path)
-    result.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
-    
-    return json.dumps(result.json())
+    return json.dumps(result)
 
-def general_insertion_query(cleaned_song_list, search_term, netease_profile):
-    
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
 
-    # This is the SQL query template for inserting data
-    insert_query = """
+# This is the SQL query template for inserting data
+GENERAL_INSERT_QUERY = """
     INSERT INTO general (
         artist_search_user_profile,
         search_term,
@@ -40,19 +36,21 @@ def general_insertion_query(cleaned_song_list, search_term, netease_profile):
         mark,
         size,
         mvid,
-        json_string
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        payload_hash
+    ) VALUES %s
     ON CONFLICT (song_id) DO NOTHING;
     """
 
+
+def general_rows(cleaned_song_list, search_term, netease_profile) -> list[tuple]:
     # Prepare data for insertion (assuming the search_term and artist_search_user_profile are known)
     search_term = search_term
     artist_search_user_profile = netease_profile
 
-    # Iterate over the artists and insert each one
+    # Iterate over the songs and collect one row each
+    rows = []
     for i in cleaned_song_list:
-        # Execute the insert query with the data
-        cursor.execute(insert_query, (
+        rows.append((
             artist_search_user_profile,
             search_term,
             i["song_id"],
@@ -70,64 +68,53 @@ def general_insertion_query(cleaned_song_list, search_term, netease_profile):
             i["mark"],
             i["size"],
             i["mvid"],
-            json.dumps(i['json_string'], ensure_ascii=False),
+            i['json_string'], # the raw response, stored once in api_payload and replaced by its hash
         ))
 
-    # Commit the transaction
-    conn.commit()
+    return rows
+
+
+def general_insertion_query(cleaned_song_list, search_term, netease_profile, page_size=INSERT_PAGE_SIZE):
+    # Execute the insert query with the data, page_size rows per statement
+    insert_with_payloads(GENERAL_INSERT_QUERY, general_rows(cleaned_song_list, search_term, netease_profile), page_size, DB_PARAMS)
+
+
+def general_writer(writer_threads=1):
+    """Background writer that batches general rows from every search term"""
+    writer = BackgroundWriter(writer_threads)
+    writer.register("general", lambda rows: insert_with_payloads(GENERAL_INSERT_QUERY, rows, db_params=DB_PARAMS))
 
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
+    return writer
 
 
 
 if __name__ == '__main__':
-    create_table(DB_PARAMS,
-        """
-           CREATE TABLE IF NOT EXISTS general (
-                artist_search_user_profile TEXT,
-                search_term TEXT,
-                song_id BIGINT PRIMARY KEY,
-                song_name TEXT,
-                artist_name TEXT,
-                artist_id TEXT,
-                album_name TEXT,
-                album_id BIGINT,
-                publish_time TEXT,
-                copyright_id BIGINT,
-                status INTEGER,
-                duration INTEGER,
-                alias TEXT,
-                fee BIGINT,
-                mark BIGINT,
-                size INTEGER,
-                mvid BIGINT,
-                json_string TEXT
-            );
-        """
-    )
+    migrate(DB_PARAMS)
     
-    queried_song_list = query(DB_PARAMS, """ SELECT song_name FROM song;""")
-    queried_artist_list = query(DB_PARAMS, """SELECT artist_name FROM artist;""")
+    # rows are streamed from the server, searching starts with the first one
+    queried_song_list = stream_query(DB_PARAMS, """ SELECT song_name FROM song;""")
+    queried_artist_list = stream_query(DB_PARAMS, """SELECT artist_name FROM artist;""")
     
-    try:
-        for song_name in queried_song_list:
-            raw_song_data = get_raw_song_data(API_HOST, song_name[0])
-            cleaned_song_data = clean_song_json(raw_song_data)
-            general_insertion_query(cleaned_song_data, song_name[0], NETEASE_PROFILE)
+    # rows are written in the background while the next terms are searched
+    with general_writer() as writer:
+        try:
+            for song_name in queried_song_list:
+                raw_song_data = get_raw_song_data(API_HOST, song_name[0])
+                cleaned_song_data = clean_song_json(raw_song_data)
+                writer.put_many("general", general_rows(cleaned_song_data, song_name[0], NETEASE_PROFILE))
     
-        for artist_name in queried_artist_list:
-            raw_song_data = get_raw_song_data(API_HOST, artist_name[0])
-            cleaned_song_data = clean_song_json(raw_song_data)
-            general_insertion_query(cleaned_song_data, artist_name[0], NETEASE_PROFILE)
+            for artist_name in queried_artist_list:
+                raw_song_data = get_raw_song_data(API_HOST, artist_name[0])
+                cleaned_song_data = clean_song_json(raw_song_data)
+                writer.put_many("general", general_rows(cleaned_song_data, artist_name[0], NETEASE_PROFILE))
             
         
-    except requests.exceptions.HTTPError as http_err:
-            raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
-    except requests.exceptions.RequestException as err:
-            raise Exception(f"Error fetching profile: {err}")  # Other request issues
+        except requests.exceptions.HTTPError as http_err:
+                raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
+        except requests.exceptions.RequestException as err:
+                raise Exception(f"Error fetching profile: {err}")  # Other request issues
         
+    print("search ledger:", dict(ledger_stats))
     print("task 6 complete")
     
     
@@ -1,12 +1,34 @@
 """Search the API for any songs with the same lyrics all the songs in the artists catalog."""
 
 import re
-import psycopg2
+import math
+import unicodedata
+from collections import Counter
 import requests, json
 
-from misc import create_table, DB_PARAMS, API_HOST,NETEASE_PROFILE, query, clean_song_json
-
-def clean_lyrics(raw_lyrics):
+from misc import DB_PARAMS, API_HOST,NETEASE_PROFILE, stream_query, clean_song_json
+from bulk_loader import INSERT_PAGE_SIZE
+from payload_store import insert_with_payloads
+from migrations import migrate
+from search_ledger import ledger_search, ledger_stats, normalize_term
+from db_writer import BackgroundWriter
+
+TOP_K_LINES = 3 #most distinctive lines searched per song
+MIN_LINE_CHARS = 5 #shorter normalized lines match too many songs
+MIN_CJK_LINE_CHARS = 4 #the same for CJK characters, every one of them is a word of its own
+FILLER_UNIQUE_RATIO = 0.4 #lines with fewer distinct characters than this share are filler
+CHORUS_REPEATS = 3 #a line repeated this often within a song is a chorus
+MAX_LINE_SHARE = 0.01 #lines in more than this share of songs are too common to search
+MIN_COMMON_SONGS = 5 #but a line is never too common while it is in at most this many songs
+LINE_NOISE = re.compile(r'[\W_]+')
+CJK_CHARS = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+
+
+def lyric_lines(raw_lyrics) -> list[str]:
+    """Every lyric line in order, repeats included"""
+    if not raw_lyrics:
+        return []
+    
     # Regular expression to match timestamps and lines containing '作词' or '作曲'
     pattern = re.compile(r'\[.*?\]|\n.*(作词|作曲).*')
 
@@ -16,26 +38,104 @@ def clean_lyrics(raw_lyrics):
     # Split the resulting string into a list by newlines and remove empty lines
     lyrics_list = [line.strip() for line in lyrics_only.split('\n') if line.strip()]
     
-    return list(set(lyrics_list[1:]))
+    return lyrics_list[1:]
 
 
-def get_raw_song_data(parent_path, search_term):
-    path = '/'.join([parent_path, "search?keywords=" + search_term + "&type=1006"])
+def clean_lyrics(raw_lyrics):
+    return list(set(lyric_lines(raw_lyrics)))
+
+
+def normalize_line(line) -> str:
+    """Case, width, spaces and punctuation do not make two lines different"""
+    return LINE_NOISE.sub('', unicodedata.normalize('NFKC', line).casefold())
+
+
+def is_too_short(key) -> bool:
+    """CJK characters are counted on their own, a 4 character chinese line is as distinctive as a short latin sentence"""
+    cjk = len(CJK_CHARS.findall(key))
+    return cjk < MIN_CJK_LINE_CHARS and len(key) - cjk < MIN_LINE_CHARS
+
+
+def is_filler(key) -> bool:
+    """Too short to point at one song, or mostly one repeated sound like 'lalalala' or '啊啊啊啊'"""
+    return is_too_short(key) or len(set(key)) / len(key) < FILLER_UNIQUE_RATIO
+
+
+def song_line_counts(lyrics, tlyrics=None, include_tlyrics=False) -> tuple[Counter, dict]:
+    """normalized line -> times it appears in the song, and normalized line -> the first original line"""
+    lines = lyric_lines(lyrics) + (lyric_lines(tlyrics) if include_tlyrics else [])
+    
+    counts = Counter()
+    originals = {}
+    for line in lines:
+        key = normalize_line(line)
+        if is_filler(key):
+            continue
+        counts[key] += 1
+        originals.setdefault(key, line)
+    
+    return counts, originals
+
+
+def line_document_frequencies(rows, include_tlyrics=False) -> tuple[Counter, int]:
+    """First planning pass: in how many songs every normalized line appears"""
+    document_frequencies = Counter()
+    songs = 0
+    for lyrics, tlyrics, songwriters in rows:
+        counts, _ = song_line_counts(lyrics, tlyrics, include_tlyrics)
+        document_frequencies.update(counts.keys())
+        songs += 1
     
-    result = requests.get(path)
-    result.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
+    return document_frequencies, songs
+
+
+def rank_song_lines(counts, document_frequencies, songs, top_k=TOP_K_LINES) -> list[str]:
+    """The top_k most distinctive normalized lines of a song. Choruses and lines shared by many songs are dropped,
+    the rest are ranked by idf, longer lines first on a tie since they match fewer songs"""
+    max_songs = max(MIN_COMMON_SONGS, MAX_LINE_SHARE * songs)
+    
+    scored = []
+    for key, repeats in counts.items():
+        frequency = document_frequencies.get(key, 1)
+        if repeats >= CHORUS_REPEATS or frequency > max_songs:
+            continue
+        scored.append((math.log(songs / frequency) * math.log(1 + len(key)), key))
     
-    return json.dumps(result.json())
+    return [key for score, key in sorted(scored, reverse=True)[:top_k]]
 
 
-def lyric_insertion_query(cleaned_song_list, search_term, netease_profile):
+def plan_lyric_searches(db_params, top_k=TOP_K_LINES, include_tlyrics=False) -> list[str]:
+    """Search terms for the whole songlyric corpus: the top_k distinctive lines of every song plus its songwriters.
+    Two streamed passes, the first counts the lines across all songs, the second ranks them per song.
+    A line or songwriter shared by several songs is searched once"""
+    lyric_query = "SELECT lyrics, tlyrics, songwriters FROM songlyric;"
+    document_frequencies, songs = line_document_frequencies(stream_query(db_params, lyric_query), include_tlyrics)
     
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
+    planned = {}
+    candidate_lines = 0
+    for lyrics, tlyrics, songwriters in stream_query(db_params, lyric_query):
+        counts, originals = song_line_counts(lyrics, tlyrics, include_tlyrics)
+        candidate_lines += len(counts)
+        
+        for key in rank_song_lines(counts, document_frequencies, songs, top_k):
+            planned.setdefault(key, originals[key])
+        
+        # after lyric search do song writers serach as well
+        if songwriters:
+            planned.setdefault(normalize_term(songwriters), songwriters)
+    
+    print("songs:", songs, "distinct lines before planning:", candidate_lines, "planned searches:", len(planned))
+    return list(planned.values())
+
 
-    # This is the SQL query template for inserting data
-    insert_query = """
+def get_raw_song_data(parent_path, search_term):
+    result = ledger_search(search_term, 1006, host=parent_path)
+    
+    return json.dumps(result)
+
+
+# This is the SQL query template for inserting data
+LYRIC_INSERT_QUERY = """
     INSERT INTO lyric (
         artist_search_user_profile,
         search_term,
@@ -49,19 +149,21 @@ def lyric_insertion_query(cleaned_song_list, search_term, netease_profile):
         fee,
         mark,
         size,
-        json_string
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        payload_hash
+    ) VALUES %s
     ON CONFLICT (song_id) DO NOTHING;
     """
 
+
+def lyric_rows(cleaned_song_list, search_term, netease_profile) -> list[tuple]:
     # Prepare data for insertion (assuming the search_term and artist_search_user_profile are known)
     search_term = search_term
     artist_search_user_profile = netease_profile
 
-    # Iterate over the artists and insert each one
+    # Iterate over the songs and collect one row each
+    rows = []
     for i in cleaned_song_list:
-        # Execute the insert query with the data
-        cursor.execute(insert_query, (
+        rows.append((
             artist_search_user_profile,
             search_term,
             i["song_id"],
@@ -74,65 +176,43 @@ def lyric_insertion_query(cleaned_song_list, search_term, netease_profile):
             i["fee"],
             i["mark"],
             i["size"],
-            json.dumps(i['json_string'], ensure_ascii=False),
+            i['json_string'], # the raw response, stored once in api_payload and replaced by its hash
         ))
 
-    # Commit the transaction
-    conn.commit()
+    return rows
+
 
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
+def lyric_insertion_query(cleaned_song_list, search_term, netease_profile, page_size=INSERT_PAGE_SIZE):
+    # Execute the insert query with the data, page_size rows per statement
+    insert_with_payloads(LYRIC_INSERT_QUERY, lyric_rows(cleaned_song_list, search_term, netease_profile), page_size, DB_PARAMS)
+
+
+def lyric_writer(writer_threads=1):
+    """Background writer that batches lyric rows from every search term"""
+    writer = BackgroundWriter(writer_threads)
+    writer.register("lyric", lambda rows: insert_with_payloads(LYRIC_INSERT_QUERY, rows, db_params=DB_PARAMS))
+
+    return writer
 
 
 if __name__ == '__main__':
-    create_table(DB_PARAMS,
-        """
-            CREATE TABLE IF NOT EXISTS lyric (
-                artist_search_user_profile TEXT,
-                search_term TEXT,
-                song_id BIGINT PRIMARY KEY,
-                song_name TEXT,
-                artist_name TEXT,
-                artist_id TEXT,
-                publish_time TEXT,
-                copyright_id BIGINT,
-                status INTEGER,
-                fee BIGINT,
-                mark BIGINT,
-                size INTEGER,
-                json_string TEXT
-            );
-        """
-    )
+    migrate(DB_PARAMS)
     
-    queried_list = query(DB_PARAMS, "SELECT lyrics, tlyrics, songwriters FROM songlyric;")
-
-    for lyrics, tlyrics, songwriters in queried_list:
-        try:
-            cleaned_lyrics_list = clean_lyrics(lyrics)
-            cleaned_tlyrics_list = clean_lyrics(tlyrics)
-            
-            # traverse through each line of the lyrics to search for result
-            for line in cleaned_lyrics_list:
-                raw_song_data = get_raw_song_data(API_HOST, line)
-                cleaned_song_data = clean_song_json(raw_song_data)
-                lyric_insertion_query(cleaned_song_data, line, NETEASE_PROFILE)
-                
-            # traverse through each line of the tlyrics to search for result
-            for tline in cleaned_tlyrics_list:
-                raw_song_data = get_raw_song_data(API_HOST, tline)
+    # only the distinctive lines of the corpus are searched, each of them once
+    search_terms = plan_lyric_searches(DB_PARAMS, TOP_K_LINES)
+
+    # rows are written in the background while the next lines are searched
+    with lyric_writer() as writer:
+        for term in search_terms:
+            try:
+                raw_song_data = get_raw_song_data(API_HOST, term)
                 cleaned_song_data = clean_song_json(raw_song_data)
-                lyric_insertion_query(cleaned_song_data, tline, NETEASE_PROFILE)
-                
-            # after lyric search do song writers serach as well
-            raw_song_data = get_raw_song_data(API_HOST, songwriters)
-            cleaned_song_data = clean_song_json(raw_song_data)
-            lyric_insertion_query(cleaned_song_data, songwriters, NETEASE_PROFILE)
+                writer.put_many("lyric", lyric_rows(cleaned_song_data, term, NETEASE_PROFILE))
         
-        except requests.exceptions.HTTPError as http_err:
-            raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
-        except requests.exceptions.RequestException as err:
-            raise Exception(f"Error fetching profile: {err}")  # Other request issues
+            except requests.exceptions.HTTPError as http_err:
+                raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
+            except requests.exceptions.RequestException as err:
+                raise Exception(f"Error fetching profile: {err}")  # Other request issues
     
+    print("search ledger:", dict(ledger_stats))
     print("task 5 complete")
\ No newline at end of file
@@ -0,0 +1,279 @@
+"""Versioned schema for all task tables. Every migration runs once, in order, and is recorded in schema_migrations.
+Run this module (or migrate()) before starting a task"""
+
+from db_pool import DB_PARAMS, transaction
+from payload_store import CREATE_PAYLOAD_TABLE, json_columns_to_jsonb, create_payload_indexes
+
+MIGRATION_LOCK = 7301 #advisory lock id, two tasks starting at once do not migrate twice
+
+CREATE_MIGRATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at TIMESTAMP DEFAULT NOW()
+    );
+"""
+
+# the search tables share their layout up to the type specific columns
+SEARCH_TABLES = {
+    'artist': """
+        artist_search_user_profile TEXT,
+        search_term TEXT,
+        artist_name TEXT,
+        artist_id BIGINT PRIMARY KEY,
+        trans TEXT,
+        artistcount INTEGER,
+        hlwords TEXT,
+        albumsize INTEGER,
+        mvsize INTEGER""",
+    'song': """
+        artist_search_user_profile TEXT,
+        search_term TEXT,
+        song_id BIGINT PRIMARY KEY,
+        song_name TEXT,
+        song_trans TEXT,
+        artist_name TEXT,
+        artist_id TEXT,
+        album_name TEXT,
+        album_id BIGINT,
+        publish_time TEXT,
+        copyright_id BIGINT,
+        status INTEGER,
+        fee BIGINT,
+        mark BIGINT,
+        size INTEGER,
+        mvid BIGINT""",
+    'lyric': """
+        artist_search_user_profile TEXT,
+        search_term TEXT,
+        song_id BIGINT PRIMARY KEY,
+        song_name TEXT,
+        artist_name TEXT,
+        artist_id TEXT,
+        publish_time TEXT,
+        copyright_id BIGINT,
+        status INTEGER,
+        fee BIGINT,
+        mark BIGINT,
+        size INTEGER""",
+    'general': """
+        artist_search_user_profile TEXT,
+        search_term TEXT,
+        song_id BIGINT PRIMARY KEY,
+        song_name TEXT,
+        artist_name TEXT,
+        artist_id TEXT,
+        album_name TEXT,
+        album_id BIGINT,
+        publish_time TEXT,
+        copyright_id BIGINT,
+        status INTEGER,
+        duration INTEGER,
+        alias TEXT,
+        fee BIGINT,
+        mark BIGINT,
+        size INTEGER,
+        mvid BIGINT""",
+}
+
+
+def task_tables(cursor) -> None:
+    for table, columns in SEARCH_TABLES.items():
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} ({columns},
+                json_string JSONB,
+                payload_hash TEXT
+            );
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS payload_hash TEXT;
+        """)
+
+    cursor.execute(CREATE_PAYLOAD_TABLE)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS audit_artists_to_scrape (
+            artist_id BIGINT PRIMARY KEY,
+            finished BOOLEAN NOT NULL DEFAULT FALSE
+        );
+
+        CREATE TABLE IF NOT EXISTS audit_songs (
+            search_term TEXT,
+            song_id BIGINT PRIMARY KEY,
+            song_name TEXT,
+            tns TEXT,
+            artist_name TEXT,
+            artist_id BIGINT,
+            fee INTEGER,
+            popularity INTEGER,
+            mst INTEGER,
+            copyright_id BIGINT,
+            no INTEGER,
+            scrape_time TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS audit_songs_to_scrape (
+            song_id BIGINT PRIMARY KEY,
+            lyrics_finished BOOLEAN NOT NULL DEFAULT FALSE
+        );
+
+        --The id that is not used should be -1
+        CREATE TABLE IF NOT EXISTS audit_json (
+            artist_id bigint NOT NULL,
+            song_id bigint NOT NULL,
+            api_text jsonb,
+            CONSTRAINT audit_json_pkey PRIMARY KEY (artist_id, song_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS audit_song_lyrics (
+            song_id bigint,
+            lyric_id bigint,
+            is_music_only boolean DEFAULT false,
+            songwriters text,
+            user_status integer,
+            user_id bigint,
+            uptime text,
+            version integer,
+            scrape_time timestamp without time zone,
+            lyrics text,
+            tlyrics text,
+            CONSTRAINT audit_song_lyrics_pkey PRIMARY KEY (lyric_id)
+        );
+        CREATE SEQUENCE IF NOT EXISTS lyric_id_seq OWNED BY audit_song_lyrics.lyric_id;
+        ALTER TABLE audit_song_lyrics ALTER COLUMN lyric_id SET DEFAULT nextval('lyric_id_seq'::regclass);
+    """)
+
+
+def audit_json_lyric_rows(cursor) -> None:
+    """Lyric payloads are written with lyric_song_id, the old key put all of them on (-1, -1)"""
+    cursor.execute("""
+        ALTER TABLE audit_json ADD COLUMN IF NOT EXISTS lyric_song_id bigint NOT NULL DEFAULT -1;
+        ALTER TABLE audit_json ALTER COLUMN artist_id SET DEFAULT -1;
+        ALTER TABLE audit_json ALTER COLUMN song_id SET DEFAULT -1;
+        ALTER TABLE audit_json DROP CONSTRAINT IF EXISTS audit_json_pkey;
+        ALTER TABLE audit_json ADD CONSTRAINT audit_json_pkey PRIMARY KEY (artist_id, song_id, lyric_song_id);
+    """)
+
+
+def lyrics_key(cursor) -> None:
+    """audit_song_lyrics is keyed on song_id + version, lyric_id stays as a plain column"""
+    cursor.execute("""
+        UPDATE audit_song_lyrics SET version = -1 WHERE version IS NULL;
+        DELETE FROM audit_song_lyrics a USING audit_song_lyrics b
+        WHERE a.song_id = b.song_id AND a.version = b.version AND a.lyric_id < b.lyric_id;
+        DELETE FROM audit_song_lyrics WHERE song_id IS NULL;
+
+        ALTER TABLE audit_song_lyrics DROP CONSTRAINT IF EXISTS audit_song_lyrics_pkey;
+        ALTER TABLE audit_song_lyrics ADD CONSTRAINT audit_song_lyrics_pkey PRIMARY KEY (song_id, version);
+    """)
+
+
+def scrape_queue_indexes(cursor) -> None:
+    """The queues are polled for unfinished rows, partial indexes only hold those and shrink as the work gets done.
+    audit_song_lyrics has no foreign key to audit_songs_to_scrape: get_lyrics_for_songs fetches lyrics for any
+    song id, queued or not"""
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS audit_artists_to_scrape_unfinished_idx
+            ON audit_artists_to_scrape (artist_id) WHERE finished = FALSE;
+        CREATE INDEX IF NOT EXISTS audit_songs_to_scrape_lyrics_unfinished_idx
+            ON audit_songs_to_scrape (song_id) WHERE lyrics_finished = FALSE;
+        CREATE INDEX IF NOT EXISTS audit_songs_artist_id_idx ON audit_songs (artist_id);
+    """)
+
+
+def jsonb_payloads(cursor) -> None:
+    json_columns_to_jsonb(cursor)
+    create_payload_indexes(cursor)
+
+
+def work_queue_leases(cursor) -> None:
+    """Lease columns for work_queue.WorkQueue"""
+    for table in ('audit_artists_to_scrape', 'audit_songs_to_scrape'):
+        cursor.execute(f"""
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS lease_owner TEXT;
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS last_error TEXT;
+        """)
+
+
+def lyric_retries(cursor) -> None:
+    """Songs whose lyrics could not be fetched, written by song_lyrics_t4.harvest_lyrics"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS audit_lyric_retries (
+            song_id BIGINT PRIMARY KEY,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            last_error TEXT,
+            last_attempt TIMESTAMPTZ DEFAULT NOW()
+        );
+    """)
+
+
+def artist_catalog_totals(cursor) -> None:
+    """Catalog size per artist at the last refresh, see catalog_search_t2.refresh_catalogs"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS audit_artist_catalog (
+            artist_id BIGINT PRIMARY KEY,
+            total INTEGER NOT NULL,
+            refreshed_at TIMESTAMPTZ DEFAULT NOW()
+        );
+    """)
+
+
+def search_ledger(cursor) -> None:
+    """Searches shared by the search tasks, see search_ledger.py"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS search_ledger (
+            term TEXT NOT NULL,
+            search_type INTEGER NOT NULL,
+            payload_hash TEXT NOT NULL,
+            searched_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (term, search_type)
+        );
+    """)
+
+
+# (version, name, function(cursor)), append new migrations at the end and never change an applied one
+MIGRATIONS = [
+    (1, "task tables", task_tables),
+    (2, "audit_json key for lyric rows", audit_json_lyric_rows),
+    (3, "audit_song_lyrics keyed on song_id + version", lyrics_key),
+    (4, "scrape queue indexes", scrape_queue_indexes),
+    (5, "jsonb payload columns and indexes", jsonb_payloads),
+    (6, "work queue leases", work_queue_leases),
+    (7, "lyric retry table", lyric_retries),
+    (8, "artist catalog totals", artist_catalog_totals),
+    (9, "search ledger", search_ledger),
+]
+
+
+def applied_versions(cursor) -> set:
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(db_params=None, target=None) -> list:
+    """Apply every migration up to target (all by default) that has not run yet, one transaction each.
+    Returns the applied versions"""
+    db_params = db_params or DB_PARAMS
+    with transaction(db_params) as cursor:
+        cursor.execute(CREATE_MIGRATIONS_TABLE)
+
+    applied = []
+    for version, name, fn in MIGRATIONS:
+        if target is not None and version > target:
+            break
+
+        with transaction(db_params) as cursor:
+            # held until commit, a second migrator waits here and then sees the version as applied
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK,))
+            if version in applied_versions(cursor):
+                continue
+
+            print("migrating to", version, name)
+            fn(cursor)
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            applied.append(version)
+
+    return applied
+
+
+if __name__ == '__main__':
+    migrate(DB_PARAMS)
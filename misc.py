@@ -1,55 +1,56 @@
 """library for audit"""
 
 from lxml.html import fromstring
-import requests, json, psycopg2, datetime
-
-# Replace these variables with your database credentials
-DB_PARAMS = {
-    'database': 'netease_max',
-    'user': 'max',
-    'password': '123',
-    'host': 'cma.cps7ukarrgmb.us-east-1.rds.amazonaws.com',
-    'port': '5432'
-}
-
-API_HOST = 'http://18.119.235.232:3000'
+import requests, json, datetime, asyncio, uuid
+
+from db_pool import DB_PARAMS, get_connection, transaction
+from api_client import API_HOST, api_get_async, run_sync, gather_bounded, get_album_cache
+
 NETEASE_PROFILE = 'https://music.163.com/#/artist?id=1060019'
 
+SONG_DETAIL_BATCH_SIZE = 500 #max ids per song/detail request, longer id lists are split into chunks
+SONG_DETAIL_WORKERS = 8 #song/detail chunks requested at the same time
+ALBUM_WORKERS = 16 #album requests in flight at the same time
+STREAM_FETCH_SIZE = 2000 #rows pulled from the server per round trip by stream_query
+
 
 def create_table(DB_PARAMS, query):
     """table creation functions"""
-    # Establish a connection to the database
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-    
     # SQL statement to create a table if it does not exist
     create_table_query = query
     
-    # Execute the create table query
-    cursor.execute(create_table_query)
-    
-    # Commit the changes
-    conn.commit()
-    
-    # Close cursor and connection
-    cursor.close()
-    conn.close()
+    # Execute the create table query, committed when the block ends
+    with transaction(DB_PARAMS) as cursor:
+        cursor.execute(create_table_query)
     # print("Table created successfully or already exists.")
     
     
 def query(DB_PARAMS, query):
-    """Establish a connection to the database"""
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-
-    # Execute the selection
-    cursor.execute(query)
-    # Fetch all the results
-    result = cursor.fetchall()
+    """Run a selection on a pooled connection"""
+    with transaction(DB_PARAMS) as cursor:
+        # Execute the selection
+        cursor.execute(query)
+        # Fetch all the results
+        result = cursor.fetchall()
     
     return result
 
 
+def stream_query(DB_PARAMS, query, fetch_size=STREAM_FETCH_SIZE, params=None):
+    """Yield the rows of a selection through a server-side cursor, fetch_size rows at a time,
+    so the whole result never has to fit in memory"""
+    with get_connection(DB_PARAMS) as conn:
+        # a named cursor keeps the result set on the server
+        cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex[:8]}")
+        cursor.itersize = fetch_size
+        try:
+            cursor.execute(query, params)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+
 def get_artist_name_from_xpath(profile_link):
     try:
         response = requests.get(profile_link)
@@ -77,39 +78,118 @@ def get_artist_name_from_xpath(profile_link):
         raise Exception(f"Profile parsing issue: {ve}")  # Parsing issues
 
 
-def get_song_details(song_ids: list) -> dict:
-    song_ids_string = ",".join(song_ids)
-    url_song_api = f"{API_HOST}/song/detail?ids={song_ids_string}"
-    response = requests.get(url_song_api)
-    response.raise_for_status()
+def chunk_list(items: list, size: int) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+async def iter_song_details_async(song_ids: list, batch_size=SONG_DETAIL_BATCH_SIZE, workers=SONG_DETAIL_WORKERS):
+    """Yields the song/detail response of every chunk of song_ids as soon as it arrives"""
+    semaphore = asyncio.Semaphore(workers)
+    
+    async def fetch(chunk):
+        async with semaphore:
+            return await api_get_async("song/detail", {"ids": ",".join(chunk)})
     
-    return response.json()
+    chunks = chunk_list([str(song_id) for song_id in song_ids], batch_size)
+    tasks = [asyncio.ensure_future(fetch(chunk)) for chunk in chunks]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # stop the remaining chunks if the caller gives up early or a chunk failed
+        for task in tasks:
+            task.cancel()
 
 
-def get_album_details(album_id) -> dict:
-    url_album_api = f"{API_HOST}/album?id={album_id}"
-    response = requests.get(url_album_api)
-    response.raise_for_status()
+async def get_song_details_async(song_ids: list, batch_size=SONG_DETAIL_BATCH_SIZE, workers=SONG_DETAIL_WORKERS) -> dict:
+    """song/detail for any number of ids. Only songs and privileges of each chunk are kept in the merged result"""
+    song_details = {"code": 200, "songs": [], "privileges": []}
+    
+    async for chunk_details in iter_song_details_async(song_ids, batch_size, workers):
+        song_details["songs"] += chunk_details.get("songs", [])
+        song_details["privileges"] += chunk_details.get("privileges", [])
     
-    return response.json()
+    return song_details
 
 
-def get_follower_count(artist_id) -> dict:
+async def get_album_details_async(album_id) -> dict:
+    return await api_get_async("album", {"id": album_id})
+
+
+async def get_album_metadata_async(album_ids, workers=ALBUM_WORKERS) -> dict:
+    """album_id -> album_name, company, publish_time for every unique album_id.
+    Known albums come from the album cache, a failed album is left out of the result"""
+    album_ids = {int(album_id) for album_id in album_ids} - {0}
+    album_cache = get_album_cache()
+    
+    albums = album_cache.get_many(album_ids)
+    
+    async def fetch(album_id):
+        try:
+            album = (await get_album_details_async(album_id))["album"]
+            return album_id, {"album_name": album["name"], "company": album["company"], "publish_time": album["publishTime"]}
+        except Exception as e:
+            print("no album details", album_id, e)
+            return album_id, None
+    
+    missing_ids = [album_id for album_id in album_ids if album_id not in albums]
+    fetched = {album_id: album for album_id, album in await gather_bounded([fetch(album_id) for album_id in missing_ids], workers) if album}
+    
+    album_cache.set_many(fetched)
+    albums.update(fetched)
+    
+    return albums
+
+
+async def get_follower_count_async(artist_id) -> dict:
     """follower == fans"""
-    url_album_api = f"{API_HOST}/artist/follow/count?id={artist_id}"
-    response = requests.get(url_album_api)
-    response.raise_for_status()
+    return await api_get_async("artist/follow/count", {"id": artist_id})
+
+
+async def get_comments_async(song_id, limit=1) -> dict:
+    return await api_get_async("comment/event", {"threadId": f"R_SO_4_{song_id}", "limit": limit})
+
+
+async def get_lyric_async(song_id) -> dict:
+    return await api_get_async("lyric", {"id": song_id})
+
+
+async def search_async(keywords, search_type=None, host=None) -> dict:
+    """search route, type 1 = songs (default), 100 = artists, 1006 = lyrics"""
+    params = {"keywords": keywords}
+    if search_type is not None:
+        params["type"] = search_type
     
-    return response.json()
+    return await api_get_async("search", params, host=host)
+
+
+def get_song_details(song_ids: list, batch_size=SONG_DETAIL_BATCH_SIZE, workers=SONG_DETAIL_WORKERS) -> dict:
+    return run_sync(get_song_details_async(song_ids, batch_size, workers))
+
+
+def get_album_details(album_id) -> dict:
+    return run_sync(get_album_details_async(album_id))
+
+
+def get_album_metadata(album_ids, workers=ALBUM_WORKERS) -> dict:
+    return run_sync(get_album_metadata_async(album_ids, workers))
+
+
+def get_follower_count(artist_id) -> dict:
+    """follower == fans"""
+    return run_sync(get_follower_count_async(artist_id))
 
 
 def get_comments(song_id, limit=1):
-    url_comment_api = f"{API_HOST}/comment/event?threadId=R_SO_4_{song_id}&limit={limit}"
-    
-    response = requests.get(url_comment_api)
-    response.raise_for_status()
+    return run_sync(get_comments_async(song_id, limit))
+
+
+def get_lyric(song_id) -> dict:
+    return run_sync(get_lyric_async(song_id))
+
 
-    return response.json()
+def search(keywords, search_type=None, host=None) -> dict:
+    return run_sync(search_async(keywords, search_type, host))
 
 
 def get_id_from_netease_url(url):
@@ -0,0 +1,165 @@
+"""Content-addressed store for raw API payloads: every distinct payload is saved once and rows keep its hash.
+Payloads are jsonb, extract_fields reads single keys on the server instead of parsing documents in Python"""
+
+import hashlib
+import json
+import zlib
+
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from db_pool import transaction
+from bulk_loader import batched_insert, iter_batches, jsonb_text, INSERT_PAGE_SIZE
+from misc import stream_query
+
+PAYLOAD_COMPRESSION = False #zlib the stored payloads, smaller table but they can no longer be queried in sql
+COMPRESSION_LEVEL = 6
+
+CREATE_PAYLOAD_TABLE = """
+    CREATE TABLE IF NOT EXISTS api_payload (
+        payload_hash TEXT PRIMARY KEY,
+        body JSONB,
+        body_zlib BYTEA,
+        size INTEGER,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+"""
+
+PAYLOAD_TABLES = ('artist', 'song', 'lyric', 'general') #rows point to api_payload through payload_hash, older rows still have json_string
+JSON_COLUMNS = {'artist': 'json_string', 'song': 'json_string', 'lyric': 'json_string', 'general': 'json_string',
+                'audit_json': 'api_text', 'api_payload': 'body'}
+
+# jsonb_path_ops GIN indexes answer containment probes like api_text @> '{"privilege": {"st": -200}}'
+# the expression indexes are used when a query repeats the expression, e.g. WHERE api_text->>'cp' = '7001'
+PAYLOAD_INDEXES = [
+    ('api_payload', "CREATE INDEX IF NOT EXISTS api_payload_body_gin ON api_payload USING GIN (body jsonb_path_ops)"),
+    ('audit_json', "CREATE INDEX IF NOT EXISTS audit_json_api_text_gin ON audit_json USING GIN (api_text jsonb_path_ops)"),
+    ('audit_json', "CREATE INDEX IF NOT EXISTS audit_json_cp_idx ON audit_json ((api_text->>'cp'))"),
+    ('audit_json', "CREATE INDEX IF NOT EXISTS audit_json_album_id_idx ON audit_json ((api_text->'al'->>'id'))"),
+] + [(table, f"CREATE INDEX IF NOT EXISTS {table}_json_string_gin ON {table} USING GIN (json_string jsonb_path_ops)") for table in PAYLOAD_TABLES] \
+  + [(table, f"CREATE INDEX IF NOT EXISTS {table}_payload_hash_idx ON {table} (payload_hash)") for table in PAYLOAD_TABLES]
+
+
+def canonical_json(payload) -> str:
+    return jsonb_text(payload, sort_keys=True, separators=(',', ':'))
+
+
+def payload_hash(payload) -> str:
+    return hashlib.sha256(canonical_json(payload).encode('utf-8')).hexdigest()
+
+
+def store_payloads(payloads: dict, compress=None, db_params=None) -> None:
+    """payloads maps hash -> payload. Payloads that are already stored are skipped by the primary key"""
+    compress = PAYLOAD_COMPRESSION if compress is None else compress
+
+    rows = []
+    for key, payload in payloads.items():
+        body = canonical_json(payload)
+        if compress:
+            rows.append((key, None, zlib.compress(body.encode('utf-8'), COMPRESSION_LEVEL), len(body)))
+        else:
+            rows.append((key, body, None, len(body)))
+
+    for batch in iter_batches(rows, INSERT_PAGE_SIZE):
+        with transaction(db_params) as cursor:
+            execute_values(cursor, """
+                INSERT INTO api_payload (payload_hash, body, body_zlib, size) VALUES %s
+                ON CONFLICT (payload_hash) DO NOTHING""", batch)
+
+
+def load_payload(key, db_params=None):
+    with transaction(db_params) as cursor:
+        cursor.execute("SELECT body, body_zlib FROM api_payload WHERE payload_hash = %s", (key,))
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    body, body_zlib = row
+    if body is None:
+        return json.loads(zlib.decompress(bytes(body_zlib)).decode('utf-8'))
+
+    # psycopg2 already decodes jsonb
+    return body
+
+
+def replace_payloads_with_hashes(rows) -> tuple[list, dict]:
+    """rows end with a raw payload object. Returns the rows ending with its hash instead, and hash -> payload.
+    Rows cleaned from the same response share one payload object, so each object is only hashed once"""
+    hashes_by_object = {}
+    payloads = {}
+    hashed_rows = []
+
+    for row in rows:
+        payload = row[-1]
+        # rows keep the payload alive, so id() is unique for the whole loop
+        key = hashes_by_object.get(id(payload))
+        if key is None:
+            key = hashes_by_object[id(payload)] = payload_hash(payload)
+            payloads[key] = payload
+
+        hashed_rows.append(tuple(row[:-1]) + (key,))
+
+    return hashed_rows, payloads
+
+
+def insert_with_payloads(insert_query, rows, page_size=INSERT_PAGE_SIZE, db_params=None) -> int:
+    """batched_insert for rows whose last value is the raw payload: the payload is stored once in api_payload
+    and the row gets its hash (insert_query's last column must be payload_hash)"""
+    hashed_rows, payloads = replace_payloads_with_hashes(rows)
+    store_payloads(payloads, db_params=db_params)
+
+    return batched_insert(insert_query, hashed_rows, page_size, db_params)
+
+
+def json_path(document, path) -> sql.Composable:
+    """'al.id' -> (document->'al'->>'id'), numeric keys index into arrays"""
+    keys = [int(key) if key.isdigit() else key for key in path.split('.')]
+    expression = sql.SQL(document)
+    for key in keys[:-1]:
+        expression = sql.SQL("{}->{}").format(expression, sql.Literal(key))
+
+    return sql.SQL("({}->>{})").format(expression, sql.Literal(keys[-1]))
+
+
+def extract_fields(table, fields, columns=(), where=None, params=None, db_params=None):
+    """Stream (columns..., fields...) rows where fields maps names to key paths, e.g. {'cp': 'cp', 'album_id': 'al.id'}.
+    The values are extracted on the server, only they cross the network. where is sql with %s placeholders for params"""
+    if table in PAYLOAD_TABLES:
+        source = sql.SQL("{} AS t LEFT JOIN api_payload AS p ON p.payload_hash = t.payload_hash").format(sql.Identifier(table))
+        document = "COALESCE(p.body, t.json_string)"
+    else:
+        source = sql.SQL("{} AS t").format(sql.Identifier(table))
+        document = "t." + JSON_COLUMNS[table]
+
+    selected = [sql.SQL("t.{}").format(sql.Identifier(column)) for column in columns]
+    selected += [sql.SQL("{} AS {}").format(json_path(document, path), sql.Identifier(name)) for name, path in fields.items()]
+
+    query = sql.SQL("SELECT {} FROM {}").format(sql.SQL(', ').join(selected), source)
+    if where:
+        query = sql.SQL("{} WHERE {}").format(query, sql.SQL(where))
+
+    return stream_query(db_params, query, params=params)
+
+
+def json_columns_to_jsonb(cursor) -> None:
+    """Upgrade of tables created while the payload columns were TEXT, tables already on jsonb are left alone"""
+    for table, column in JSON_COLUMNS.items():
+        cursor.execute("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s""", (table, column))
+        row = cursor.fetchone()
+        if row is None or row[0] == 'jsonb':
+            continue
+
+        print("converting", table, column, "to jsonb")
+        cursor.execute(sql.SQL("ALTER TABLE {table} ALTER COLUMN {column} TYPE JSONB USING REPLACE({column}, %s, %s)::jsonb").format(
+            table=sql.Identifier(table), column=sql.Identifier(column)), ('\\u0000', '\\ufffd'))
+
+
+def create_payload_indexes(cursor) -> None:
+    """Indexes for the tables that exist, a task that has not run yet has no table to index"""
+    for table, statement in PAYLOAD_INDEXES:
+        cursor.execute("SELECT to_regclass(%s)", (table,))
+        if cursor.fetchone()[0] is not None:
+            cursor.execute(statement)
@@ -0,0 +1,136 @@
+"""Adaptive token bucket for calls to the API, shared by every thread and process on this host"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# the state lives in one file per host so separate task processes share the same budget
+RATE_LIMIT_PATH = os.path.join(tempfile.gettempdir(), 'netease_api_rate_limit.sqlite3')
+
+INITIAL_RATE = 20.0 #requests per second
+MIN_RATE = 1.0
+MAX_RATE = 200.0
+BURST_SECONDS = 1.0 #the bucket holds at most this many seconds worth of tokens
+RAMP_STEP = 2.0 #requests per second added after every quiet RAMP_INTERVAL
+RAMP_INTERVAL = 5.0 #seconds
+DECREASE_FACTOR = 0.5 #rate is multiplied by this on a throttle signal
+THROTTLE_COOLDOWN = 1.0 #throttle signals within this many seconds only count once
+
+THROTTLE_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_CODES = (405, -460, -462) #netease body codes for "too frequent" / cheating checks
+
+
+class RateLimiter():
+    def __init__(self, path=RATE_LIMIT_PATH, initial_rate=INITIAL_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE):
+        self.path = path
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                bucket TEXT PRIMARY KEY,
+                rate REAL,
+                tokens REAL,
+                updated_at REAL,
+                last_throttle REAL,
+                last_increase REAL
+            )
+        """)
+
+
+    def _load(self, bucket, now):
+        row = self.conn.execute("""
+            SELECT rate, tokens, updated_at, last_throttle, last_increase FROM buckets WHERE bucket = ?""", (bucket,)).fetchone()
+
+        if row is None:
+            return self.initial_rate, self.initial_rate * BURST_SECONDS, now, 0.0, now
+
+        return row
+
+
+    def _save(self, bucket, rate, tokens, updated_at, last_throttle, last_increase):
+        self.conn.execute("""
+            INSERT OR REPLACE INTO buckets (bucket, rate, tokens, updated_at, last_throttle, last_increase)
+            VALUES (?, ?, ?, ?, ?, ?)""", (bucket, rate, tokens, updated_at, last_throttle, last_increase))
+
+
+    def acquire(self, bucket='default') -> float:
+        """Take one token, sleeping until it is available. Returns the seconds waited"""
+        with self.lock:
+            # BEGIN IMMEDIATE takes the write lock, so other processes wait for this read-modify-write
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                rate, tokens, updated_at, last_throttle, last_increase = self._load(bucket, now)
+
+                # additive increase after a quiet period without throttle signals
+                if now - max(last_throttle, last_increase) >= RAMP_INTERVAL:
+                    rate = min(self.max_rate, rate + RAMP_STEP)
+                    last_increase = now
+
+                tokens = min(rate * BURST_SECONDS, tokens + (now - updated_at) * rate)
+                # reserve the token now, a negative balance makes the next callers queue up behind us
+                tokens -= 1
+                wait = -tokens / rate if tokens < 0 else 0.0
+
+                self._save(bucket, rate, tokens, now, last_throttle, last_increase)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+
+    def throttle(self, bucket='default') -> None:
+        """Multiplicative decrease after a 429/5xx or a netease throttle code"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                rate, tokens, updated_at, last_throttle, last_increase = self._load(bucket, now)
+
+                # a burst of failing concurrent requests is one signal, not many
+                if now - last_throttle >= THROTTLE_COOLDOWN:
+                    rate = max(self.min_rate, rate * DECREASE_FACTOR)
+                    tokens = min(tokens, 0.0)
+                    last_throttle = now
+
+                self._save(bucket, rate, tokens, updated_at, last_throttle, last_increase)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+
+    def backing_off(self, bucket='default') -> bool:
+        """True while callers queue for tokens or shortly after a throttle signal"""
+        with self.lock:
+            now = time.time()
+            rate, tokens, updated_at, last_throttle, last_increase = self._load(bucket, now)
+
+        tokens = min(rate * BURST_SECONDS, tokens + (now - updated_at) * rate)
+        return tokens < 0 or now - last_throttle < RAMP_INTERVAL
+
+
+    def current_rate(self, bucket='default') -> float:
+        with self.lock:
+            return self._load(bucket, time.time())[0]
+
+
+def is_throttle_response(status_code, data=None) -> bool:
+    # the api usually mirrors the body code in the http status
+    if status_code in THROTTLE_STATUSES or status_code in THROTTLE_CODES:
+        return True
+
+    return isinstance(data, dict) and data.get('code') in THROTTLE_CODES
@@ -0,0 +1,73 @@
+"""Ledger of keyword searches shared by all search tasks. A term searched by any task within the TTL is answered from
+the stored response in api_payload instead of calling the API again"""
+
+import threading
+import unicodedata
+from collections import Counter
+
+from db_pool import transaction
+from misc import search
+from payload_store import payload_hash, store_payloads, load_payload
+
+SEARCH_TTL_HOURS = 7 * 24 #a term is searched again once its last search is older than this
+DEFAULT_SEARCH_TYPE = 1 #what the search route uses without a type
+
+ledger_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def normalize_term(term) -> str:
+    """'  Hello   World ' and 'hello world' are one ledger entry, full width characters are folded too"""
+    return ' '.join(unicodedata.normalize('NFKC', str(term)).casefold().split())
+
+
+def count(event) -> None:
+    with _stats_lock:
+        ledger_stats[event] += 1
+
+
+def lookup(term, search_type, ttl_hours=SEARCH_TTL_HOURS, db_params=None):
+    """The stored response of a fresh search, or None"""
+    with transaction(db_params) as cursor:
+        cursor.execute("""
+            SELECT payload_hash FROM search_ledger
+            WHERE term = %s AND search_type = %s AND searched_at >= NOW() - make_interval(hours => %s)""",
+            (term, search_type, ttl_hours))
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    return load_payload(row[0], db_params)
+
+
+def record(term, search_type, result, db_params=None) -> None:
+    key = payload_hash(result)
+    store_payloads({key: result}, db_params=db_params)
+
+    with transaction(db_params) as cursor:
+        cursor.execute("""
+            INSERT INTO search_ledger (term, search_type, payload_hash, searched_at) VALUES (%s, %s, %s, NOW())
+            ON CONFLICT (term, search_type) DO UPDATE SET payload_hash = EXCLUDED.payload_hash, searched_at = EXCLUDED.searched_at""",
+            (term, search_type, key))
+
+
+def ledger_search(keywords, search_type=None, host=None, ttl_hours=SEARCH_TTL_HOURS, db_params=None) -> dict:
+    """search() through the ledger, keyed by normalized term and search type"""
+    term = normalize_term(keywords)
+    search_type = search_type or DEFAULT_SEARCH_TYPE
+    if not term:
+        return search(keywords, search_type, host=host)
+
+    result = lookup(term, search_type, ttl_hours, db_params)
+    if result is not None:
+        count("hits")
+        return result
+
+    count("misses")
+    result = search(keywords, search_type, host=host)
+    # only complete answers are shared, an error response is searched again next time
+    if isinstance(result, dict) and result.get('code') == 200:
+        record(term, search_type, result, db_params)
+
+    return result
@@ -1,21 +1,25 @@
 """Get lyrics for list of song_ids and save them to db"""
 
 import re
+import time
 import psycopg2
-import requests, json
+import requests
+from psycopg2.extras import execute_values
 
-from misc import create_table, DB_PARAMS, API_HOST, query
+from misc import get_lyric, get_lyric_async, DB_PARAMS
+from api_client import gather_bounded, run_sync
+from db_pool import transaction
+from bulk_loader import bulk_upsert, bulk_update_flags, jsonb_text
+from migrations import migrate
+from db_writer import BackgroundWriter
+from work_queue import WorkQueue
 
 BATCH_SIZE = 50 #size of lyrics written in one query
+LYRIC_WORKERS = 16 #lyric requests in flight at the same time while harvesting
 
 
 def get_raw_lyric_data(songid) -> dict:
-    path = f"{API_HOST}/lyric?id={str(songid)}"
-    
-    result = requests.get(path)
-    result.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
-
-    return result.json()
+    return get_lyric(songid)
 
 
 def clean_lyric_json(data):
@@ -58,15 +62,23 @@ def clean_lyric_json(data):
 
 
 def songlyric_insertion_query(lyric_dicts: list):
-    """Writes all dicts of lyric_dicts in one query"""
+    """Writes all dicts of lyric_dicts in one transaction, streamed with COPY through staging tables.
+    NUL bytes are replaced while the rows are streamed"""
+    try:
+        with transaction(DB_PARAMS) as cursor:
+            write_lyrics(cursor, lyric_dicts)
+            
+    except psycopg2.DatabaseError as error:
+        print("db error: ", error)
+        raise
+
+
+def write_lyrics(cursor, lyric_dicts: list, set_flags=True) -> list:
+    """The lyrics, their json and (with set_flags) lyrics_finished in the caller's transaction. Returns the written song ids"""
     audit_lyrics_args = []
     audit_json_args = []
     audit_finished_args = []
     
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-    
     for lyric_dict in lyric_dicts:
         if lyric_dict == {}:
             continue
@@ -80,113 +92,140 @@ def songlyric_insertion_query(lyric_dicts: list):
         version = lyric_dict["version"]
         lyrics = lyric_dict["lyrics"]
         tlyrics = lyric_dict["tlyrics"]
-        api_text = json.dumps(lyric_dict["json_string"], ensure_ascii=False)
+        api_text = jsonb_text(lyric_dict["json_string"])
         
         audit_lyrics_args.append((song_id, is_music_only, songwriters, user_status, user_id, uptime, version, lyrics, tlyrics))
         audit_json_args.append((song_id, api_text))
-        audit_finished_args.append((song_id,))
-    
-    audit_lyrics_args_str = ','.join(cursor.mogrify("(%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())", x).decode('utf-8', errors="replace").replace("\x00", "\uFFFD") for x in audit_lyrics_args)
-    audit_json_args_str = ','.join(cursor.mogrify("(%s, %s)", x).decode('utf-8', errors="replace").replace("\x00", "\uFFFD") for x in audit_json_args)
-    audit_finished_str = ','.join(cursor.mogrify("(%s)", x).decode('utf-8') for x in audit_finished_args)
+        audit_finished_args.append(song_id)
 
-    try:
-        cursor.execute(f"""
-            INSERT INTO audit_song_lyrics (
-                song_id, 
-                is_music_only,
-                songwriters,
-                user_status,
-                user_id,
-                uptime,
-                version,
-                lyrics,
-                tlyrics,
-                scrape_time
-            ) VALUES {audit_lyrics_args_str}"""
-        )
-        conn.commit()
-    except psycopg2.DatabaseError as error:
-        print("db error: ", error)
-        
-    try:
-        cursor.execute(f"""
-            Insert INTO audit_json (lyric_song_id, api_text)
-            VALUES {audit_json_args_str}
-            ON CONFLICT DO NOTHING"""
-        )
-        conn.commit()
-    except psycopg2.DatabaseError as error:
-        print("db error: ", error)
-        
-    try:
-        cursor.execute(f"""
-            update audit_songs_to_scrape as t set
-            lyrics_finished = True
-            from (values
-                {audit_finished_str}
-            ) as c(song_id) 
-            where c.song_id = t.song_id;
-        """)
-        conn.commit()
-    except psycopg2.DatabaseError as error:
-        print("db error: ", error)
-
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
+    bulk_upsert(cursor, "audit_song_lyrics",
+                ["song_id", "is_music_only", "songwriters", "user_status", "user_id", "uptime", "version", "lyrics", "tlyrics"],
+                audit_lyrics_args, "ON CONFLICT (song_id, version) DO NOTHING", {"scrape_time": "NOW()"})
+    
+    bulk_upsert(cursor, "audit_json", ["lyric_song_id", "api_text"], audit_json_args)
+    
+    if set_flags:
+        bulk_update_flags(cursor, "audit_songs_to_scrape", "song_id", audit_finished_args, "lyrics_finished = True")
+    
+    return audit_finished_args
 
 
 def create_t4_table():
-    #TODO: lyric_id not really needed. Maybe better use song_id + version as pk
-    create_table(DB_PARAMS,
-        """
-        CREATE TABLE IF NOT EXISTS audit_song_lyrics
-            (
-                song_id bigint,
-                lyric_id bigint,
-                is_music_only boolean DEFAULT false,
-                songwriters text COLLATE pg_catalog."default",
-                user_status integer,
-                user_id bigint,
-                uptime text COLLATE pg_catalog."default",
-                version integer,
-                scrape_time timestamp without time zone,
-                lyrics text COLLATE pg_catalog."default",
-                tlyrics text COLLATE pg_catalog."default",
-                CONSTRAINT audit_song_lyrics_pkey PRIMARY KEY (lyric_id)
-            );
-        
-        CREATE SEQUENCE IF NOT EXISTS lyric_id_seq OWNED BY audit_song_lyrics.lyric_id ;
-        ALTER  TABLE audit_song_lyrics ALTER COLUMN lyric_id SET DEFAULT nextval('lyric_id_seq'::regclass);
-        """
-    )
+    # audit_song_lyrics is keyed on song_id + version since migration 3
+    migrate(DB_PARAMS)
    
     
 def get_lyrics_for_songs(song_ids):
+    """Batches of BATCH_SIZE lyrics are written by a background writer while the next lyrics are fetched"""
     batch_counter = 0
+    with BackgroundWriter() as writer:
+        writer.register("audit_song_lyrics", songlyric_insertion_query, BATCH_SIZE)
+        
+        for song_id in song_ids:
+            try:
+                song_lyrics_raw = get_raw_lyric_data(song_id)
+                song_lyrics_dict = clean_lyric_json(song_lyrics_raw)
+                song_lyrics_dict["song_id"] = song_id
+                writer.put("audit_song_lyrics", song_lyrics_dict)
+                batch_counter += 1
+                
+                if batch_counter % BATCH_SIZE == 0:
+                    print("batch:", (batch_counter / BATCH_SIZE))
+                    
+            except requests.exceptions.HTTPError as http_err:
+                raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
+            except requests.exceptions.RequestException as err:
+                raise Exception(f"Error fetching profile: {err}")  # Other request issues
+        
+
+def fetch_lyrics(song_ids, workers=LYRIC_WORKERS) -> tuple[list[dict], dict]:
+    """Fetch lyrics concurrently. Returns the cleaned lyric dicts and song_id -> error for the songs that failed,
+    a failed song never stops the others"""
+    results = run_sync(gather_bounded([get_lyric_async(song_id) for song_id in song_ids], workers, return_exceptions=True))
+    
     lyric_dicts = []
-    for song_id in song_ids:
+    failed = {}
+    for song_id, result in zip(song_ids, results):
+        if isinstance(result, Exception):
+            failed[song_id] = result
+            continue
+        
         try:
-            song_lyrics_raw = get_raw_lyric_data(song_id)
-            song_lyrics_dict = clean_lyric_json(song_lyrics_raw)
-            song_lyrics_dict["song_id"] = song_id
-            lyric_dicts.append(song_lyrics_dict)
-            batch_counter += 1
+            song_lyrics_dict = clean_lyric_json(result)
+        except (KeyError, TypeError, AttributeError) as e:
+            failed[song_id] = e
+            continue
+        
+        song_lyrics_dict["song_id"] = song_id
+        lyric_dicts.append(song_lyrics_dict)
+    
+    return lyric_dicts, failed
+
+
+def record_lyric_failures(cursor, failed: dict) -> None:
+    execute_values(cursor, """
+        INSERT INTO audit_lyric_retries (song_id, last_error) VALUES %s
+        ON CONFLICT (song_id) DO UPDATE SET attempts = audit_lyric_retries.attempts + 1,
+            last_error = EXCLUDED.last_error, last_attempt = NOW()""",
+        [(song_id, str(error)[:1000]) for song_id, error in failed.items()])
+
+
+def commit_lyrics(work_queue, lyric_dicts, failed) -> list:
+    """Lyrics, their finished flags and the failures of a batch in one transaction. Returns the written song ids"""
+    with transaction(DB_PARAMS) as cursor:
+        written = write_lyrics(cursor, lyric_dicts, set_flags=False)
+        if written:
+            work_queue.complete(written, cursor=cursor)
+            cursor.execute("DELETE FROM audit_lyric_retries WHERE song_id = ANY(%s)", (written,))
+        if failed:
+            record_lyric_failures(cursor, failed)
+    
+    return written
+
+
+def harvest_lyrics(batch_size=BATCH_SIZE, workers=LYRIC_WORKERS) -> dict:
+    """Resumable lyric backfill. Songs are leased from audit_songs_to_scrape, fetched concurrently and every batch
+    commits its lyrics, lyrics_finished flags and failures in one transaction, so a restart continues after the last
+    committed batch. A batch that fails to write is written song by song. Songs that fail to fetch or write go to
+    audit_lyric_retries and keep their lease until it expires, then they are retried"""
+    totals = {"batches": 0, "written": 0, "failed": 0}
+    started = time.time()
+    
+    with WorkQueue("audit_songs_to_scrape", db_params=DB_PARAMS) as work_queue:
+        for song_ids in work_queue.batches(batch_size):
+            lyric_dicts, failed = fetch_lyrics(song_ids, workers)
             
-            if batch_counter % BATCH_SIZE == 0:
-                print("batch:", (batch_counter / 50))
-                songlyric_insertion_query(lyric_dicts)
-                lyric_dicts.clear()
+            try:
+                written = commit_lyrics(work_queue, lyric_dicts, failed)
+            
+            except psycopg2.DatabaseError as error:
+                # one bad song must not hold back the others, write them one at a time and record the ones that still fail
+                print("db error, writing the batch song by song: ", error)
+                written = []
+                for lyric_dict in lyric_dicts:
+                    try:
+                        written += commit_lyrics(work_queue, [lyric_dict], {})
+                    except psycopg2.DatabaseError as song_error:
+                        failed[lyric_dict["song_id"]] = song_error
                 
-        except requests.exceptions.HTTPError as http_err:
-            raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
-        except requests.exceptions.RequestException as err:
-            raise Exception(f"Error fetching profile: {err}")  # Other request issues
-               
-    if len(lyric_dicts) > 0:
-        songlyric_insertion_query(lyric_dicts)
-        
+                if failed:
+                    try:
+                        with transaction(DB_PARAMS) as cursor:
+                            record_lyric_failures(cursor, failed)
+                    except psycopg2.DatabaseError as record_error:
+                        print("db error: ", record_error)
+            
+            # not released, an immediate retry would most likely fail the same way
+            work_queue.forget(failed)
+            
+            totals["batches"] += 1
+            totals["written"] += len(written)
+            totals["failed"] += len(failed)
+            print("batch:", totals["batches"], "written:", totals["written"], "failed:", totals["failed"],
+                  f"{totals['written'] / max(time.time() - started, 1e-9):.1f} songs/s")
+    
+    return totals
+
 
 if __name__ == '__main__':
     # create_t4_table()
@@ -195,12 +234,11 @@ if __name__ == '__main__':
     # queried_list = query(DB_PARAMS, "SELECT song_id, artist_name FROM song;")
     # song_ids = [28285776] #with trans user
     
-    songs_without_lyrics = [x[0] for x in query(DB_PARAMS, "SELECT song_id FROM audit_songs_to_scrape WHERE lyrics_finished = FALSE")]
-    
     # song_ids = [17437594, 1851698391, 28285776] #without trans user
     # get_lyrics_for_songs(song_ids)
-    get_lyrics_for_songs(songs_without_lyrics)
+    
+    # songs are leased from the queue, any number of these processes can run at once and be restarted at any time
+    migrate(DB_PARAMS)
+    harvest_lyrics()
 
     # print("task 4 complete")
-        
-    
\ No newline at end of file
@@ -1,26 +1,22 @@
 """Find all songs with the same title"""
 
-import psycopg2
 import requests, json
 
-from misc import clean_song_json, create_table, DB_PARAMS, API_HOST, NETEASE_PROFILE, query
+from misc import clean_song_json, DB_PARAMS, API_HOST, NETEASE_PROFILE, stream_query
+from bulk_loader import INSERT_PAGE_SIZE
+from payload_store import insert_with_payloads
+from migrations import migrate
+from search_ledger import ledger_search, ledger_stats
+from db_writer import BackgroundWriter
 
 def get_raw_song_data(parent_path, keyword, search_type):
-    path = '/'.join([parent_path, "search?keywords=" + keyword + "&type=" + str(search_type)])
+    result = ledger_search(keyword, search_type, host=parent_path)
     
-    result = requests.get(path)
-    result.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
-    
-    return json.dumps(result.json())
+    return json.dumps(result)
 
-def song_insertion_query(cleaned_song_list, search_term, netease_profile):
-    
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
 
-    # This is the SQL query template for inserting data
-    insert_query = """
+# This is the SQL query template for inserting data
+SONG_INSERT_QUERY = """
     INSERT INTO song (
         artist_search_user_profile,
         search_term,
@@ -38,18 +34,20 @@ def song_insertion_query(cleaned_song_list, search_term, netease_profile):
         mark,
         size,
         mvid,
-        json_string
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        payload_hash
+    ) VALUES %s
     ON CONFLICT (song_id) DO NOTHING;
     """
 
+
+def song_rows(cleaned_song_list, search_term, netease_profile) -> list[tuple]:
     # Prepare data for insertion (assuming the search_term and artist_search_user_profile are known)
     artist_search_user_profile = netease_profile
 
-    # Iterate over the artists and insert each one
+    # Iterate over the songs and collect one row each
+    rows = []
     for i in cleaned_song_list:
-        # Execute the insert query with the data
-        cursor.execute(insert_query, (
+        rows.append((
             artist_search_user_profile,
             search_term,
             i["song_id"],
@@ -66,58 +64,46 @@ def song_insertion_query(cleaned_song_list, search_term, netease_profile):
             i["mark"],
             i["size"],
             i["mvid"],
-            json.dumps(i['json_string'], ensure_ascii=False),
+            i['json_string'], # the raw response, stored once in api_payload and replaced by its hash
         ))
 
-    # Commit the transaction
-    conn.commit()
+    return rows
+
+
+def song_insertion_query(cleaned_song_list, search_term, netease_profile, page_size=INSERT_PAGE_SIZE):
+    # Execute the insert query with the data, page_size rows per statement
+    insert_with_payloads(SONG_INSERT_QUERY, song_rows(cleaned_song_list, search_term, netease_profile), page_size, DB_PARAMS)
+
+
+def song_writer(writer_threads=1):
+    """Background writer that batches song rows from every search term"""
+    writer = BackgroundWriter(writer_threads)
+    writer.register("song", lambda rows: insert_with_payloads(SONG_INSERT_QUERY, rows, db_params=DB_PARAMS))
 
-    # Close the cursor and the connection
-    cursor.close()
-    conn.close()
+    return writer
 
 if __name__ == '__main__':
-    create_table(DB_PARAMS,
-        """
-            CREATE TABLE IF NOT EXISTS song (
-                artist_search_user_profile TEXT,
-                search_term TEXT,
-                song_id BIGINT PRIMARY KEY,
-                song_name TEXT,
-                song_trans TEXT,
-                artist_name TEXT,
-                artist_id TEXT,
-                album_name TEXT,
-                album_id BIGINT,
-                publish_time TEXT,
-                copyright_id BIGINT,
-                status INTEGER,
-                fee BIGINT,
-                mark BIGINT,
-                size INTEGER,
-                mvid BIGINT,
-                json_string TEXT
-            );
-        """
-    )
+    migrate(DB_PARAMS)
     
     catalog_queries = [('song_name', 1), ('artist_name',100) , ('tns', 100)]
     
-    # query from database
-    for c in catalog_queries: 
-        try:
-            queried_list = query(DB_PARAMS, "SELECT " + c[0] + " FROM catalog;")
-            queried_list = list(set(queried_list))
-            
-            for li in queried_list:
-                raw_json = get_raw_song_data(API_HOST, li[0], c[1])
-                cleaned_song_list = clean_song_json(raw_json)
-                song_insertion_query(cleaned_song_list, c[0], NETEASE_PROFILE)
-            
-        except requests.exceptions.HTTPError as http_err:
-            raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
-        except requests.exceptions.RequestException as err:
-            raise Exception(f"Error fetching profile: {err}")  # Other request issues
+    # query from database, rows are written in the background while the next terms are searched
+    with song_writer() as writer:
+        for c in catalog_queries: 
+            try:
+                # DISTINCT on the server replaces the set() dedup, so the rows can be streamed
+                queried_list = stream_query(DB_PARAMS, "SELECT DISTINCT " + c[0] + " FROM catalog;")
+                
+                for li in queried_list:
+                    raw_json = get_raw_song_data(API_HOST, li[0], c[1])
+                    cleaned_song_list = clean_song_json(raw_json)
+                    writer.put_many("song", song_rows(cleaned_song_list, c[0], NETEASE_PROFILE))
+                
+            except requests.exceptions.HTTPError as http_err:
+                raise Exception(f"HTTP error occurred: {http_err}")  # HTTP error
+            except requests.exceptions.RequestException as err:
+                raise Exception(f"Error fetching profile: {err}")  # Other request issues
         
+    print("search ledger:", dict(ledger_stats))
     print("task 3 complete")
         
@@ -0,0 +1,220 @@
+"""Job queue on top of the scrape tables: workers lease ids with FOR UPDATE SKIP LOCKED, keep the lease alive with
+heartbeats and give failed ids back for a retry. Any number of processes or machines can drain the same table"""
+
+import os
+import socket
+import threading
+import uuid
+
+from psycopg2 import sql
+
+from db_pool import transaction
+
+LEASE_SECONDS = 300 #a lease that is not renewed for this long is taken over by other workers
+HEARTBEAT_SECONDS = 60 #how often held leases are renewed
+MAX_ATTEMPTS = 5 #ids that failed this often are no longer handed out
+
+# table -> (key column, done flag)
+QUEUES = {
+    'audit_artists_to_scrape': ('artist_id', 'finished'),
+    'audit_songs_to_scrape': ('song_id', 'lyrics_finished'),
+}
+
+
+def make_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class WorkQueue():
+    """claim -> work -> complete or fail. A worker that dies keeps its ids only until the lease expires"""
+    def __init__(self, table, worker_id=None, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS,
+                 heartbeat_seconds=HEARTBEAT_SECONDS, db_params=None):
+        self.table = table
+        self.key_column, self.done_column = QUEUES[table]
+        self.worker_id = worker_id or make_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.heartbeat_seconds = heartbeat_seconds
+        self.db_params = db_params
+
+        self.held = set()
+        self.lock = threading.Lock()
+        self.heartbeat_thread = None
+        self.stopped = threading.Event()
+
+
+    def format(self, query) -> sql.Composed:
+        return sql.SQL(query).format(table=sql.Identifier(self.table), key=sql.Identifier(self.key_column),
+                                     done=sql.Identifier(self.done_column))
+
+
+    def claim(self, limit) -> list:
+        """Lease up to limit unfinished ids. Rows locked by another claim are skipped instead of waited on,
+        expired leases count as free"""
+        with transaction(self.db_params) as cursor:
+            cursor.execute(self.format("""
+                WITH next AS (
+                    SELECT {key} FROM {table}
+                    WHERE {done} = FALSE AND attempts < %(max_attempts)s
+                        AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+                    ORDER BY {key}
+                    LIMIT %(limit)s
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE {table} AS t
+                SET lease_owner = %(worker)s,
+                    lease_expires_at = NOW() + make_interval(secs => %(lease)s),
+                    attempts = t.attempts + 1
+                FROM next WHERE t.{key} = next.{key}
+                RETURNING t.{key}"""),
+                {"max_attempts": self.max_attempts, "limit": limit, "worker": self.worker_id, "lease": self.lease_seconds})
+            ids = [row[0] for row in cursor.fetchall()]
+
+        with self.lock:
+            self.held.update(ids)
+
+        return ids
+
+
+    def heartbeat(self) -> int:
+        """Renew every lease this worker still holds. Returns the number renewed, a lease that was taken over is dropped"""
+        with self.lock:
+            ids = list(self.held)
+        if not ids:
+            return 0
+
+        with transaction(self.db_params) as cursor:
+            cursor.execute(self.format("""
+                UPDATE {table} SET lease_expires_at = NOW() + make_interval(secs => %s)
+                WHERE {key} = ANY(%s) AND lease_owner = %s
+                RETURNING {key}"""), (self.lease_seconds, ids, self.worker_id))
+            renewed = {row[0] for row in cursor.fetchall()}
+
+        with self.lock:
+            lost = self.held.intersection(ids) - renewed
+            self.held -= lost
+        if lost:
+            print("lost leases", self.table, len(lost))
+
+        return len(renewed)
+
+
+    def complete(self, ids, cursor=None) -> None:
+        """Mark ids done and drop their leases. Pass cursor to commit together with the rows written for them"""
+        ids = list(ids)
+        query = self.format("""
+            UPDATE {table} SET {done} = TRUE, lease_owner = NULL, lease_expires_at = NULL, last_error = NULL
+            WHERE {key} = ANY(%s)""")
+        if cursor is None:
+            with transaction(self.db_params) as cursor:
+                cursor.execute(query, (ids,))
+        else:
+            cursor.execute(query, (ids,))
+
+        self.forget(ids)
+
+
+    def fail(self, ids, error=None) -> None:
+        """Give ids back for another attempt, the attempt counter was already raised by claim"""
+        ids = list(ids)
+        with transaction(self.db_params) as cursor:
+            cursor.execute(self.format("""
+                UPDATE {table} SET lease_owner = NULL, lease_expires_at = NULL, last_error = %s
+                WHERE {key} = ANY(%s) AND lease_owner = %s"""), (str(error)[:1000] if error else None, ids, self.worker_id))
+
+        self.forget(ids)
+
+
+    def defer(self, ids, error=None) -> None:
+        """Record the error but keep the leases, the ids are handed out again once the leases expire"""
+        ids = list(ids)
+        with transaction(self.db_params) as cursor:
+            cursor.execute(self.format("""
+                UPDATE {table} SET last_error = %s
+                WHERE {key} = ANY(%s) AND lease_owner = %s"""), (str(error)[:1000] if error else None, ids, self.worker_id))
+
+        self.forget(ids)
+
+
+    def release(self, ids, refund_attempt=True) -> None:
+        """Give ids back, e.g. on shutdown. refund_attempt=False after a run whose writes set the done flag themselves:
+        the finished ids are done anyway and the rest have used up an attempt"""
+        ids = list(ids)
+        with transaction(self.db_params) as cursor:
+            cursor.execute(self.format("""
+                UPDATE {table} SET lease_owner = NULL, lease_expires_at = NULL,
+                    attempts = CASE WHEN %s THEN GREATEST(attempts - 1, 0) ELSE attempts END
+                WHERE {key} = ANY(%s) AND lease_owner = %s"""), (refund_attempt, ids, self.worker_id))
+
+        self.forget(ids)
+
+
+    def forget(self, ids) -> None:
+        with self.lock:
+            self.held.difference_update(ids)
+
+
+    def reclaim_expired(self) -> int:
+        """Clear leases of dead workers. claim already ignores expired leases, this keeps the table readable"""
+        with transaction(self.db_params) as cursor:
+            cursor.execute(self.format("""
+                UPDATE {table} SET lease_owner = NULL, lease_expires_at = NULL
+                WHERE {done} = FALSE AND lease_expires_at < NOW()"""))
+            return cursor.rowcount
+
+
+    def stats(self) -> dict:
+        with transaction(self.db_params) as cursor:
+            cursor.execute(self.format("""
+                SELECT COUNT(*) FILTER (WHERE {done}),
+                       COUNT(*) FILTER (WHERE NOT {done} AND lease_expires_at >= NOW()),
+                       COUNT(*) FILTER (WHERE NOT {done} AND attempts >= %s),
+                       COUNT(*) FILTER (WHERE NOT {done})
+                FROM {table}"""), (self.max_attempts,))
+            done, leased, gave_up, unfinished = cursor.fetchone()
+
+        return {"done": done, "leased": leased, "gave_up": gave_up, "pending": unfinished - gave_up}
+
+
+    def start_heartbeat(self) -> None:
+        with self.lock:
+            if self.heartbeat_thread is None:
+                self.heartbeat_thread = threading.Thread(target=self.heartbeat_loop, name=f"heartbeat-{self.table}", daemon=True)
+                self.heartbeat_thread.start()
+
+
+    def heartbeat_loop(self) -> None:
+        while not self.stopped.wait(self.heartbeat_seconds):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                # the next beat tries again, leases only expire after lease_seconds
+                print("heartbeat error", self.table, e)
+
+
+    def stop(self) -> None:
+        """Stop the heartbeat and hand back whatever is still held"""
+        self.stopped.set()
+        with self.lock:
+            held = list(self.held)
+        if held:
+            self.release(held)
+
+
+    def batches(self, batch_size=100):
+        """Yield leased batches until the queue is drained, the heartbeat runs meanwhile"""
+        self.start_heartbeat()
+        while True:
+            ids = self.claim(batch_size)
+            if not ids:
+                return
+            yield ids
+
+
+    def __enter__(self):
+        self.start_heartbeat()
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()